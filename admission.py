@@ -0,0 +1,168 @@
+"""アドミッション制御（レート制限と同時実行数制限）
+
+交代時間帯などに多数の端末から一斉にアクセスされた場合でもDBを守るため、
+セッション/IPごとのトークンバケットによるレート制限と、
+DB負荷の高いルートに対する同時実行数制限（待ち行列付き）を行う。
+
+どちらもワーカープロセスごとの制限で、gunicornのワーカー間では共有しない。
+ログインのレート制限だけは、全ワーカー合計で設定値を超えないよう
+ワーカー数（WEB_CONCURRENCY）で割った値を各ワーカーに割り当てる。
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+# gunicornのワーカー数・ワーカーあたりのスレッド数（gunicorn.conf.py と同じ環境変数）
+WEB_CONCURRENCY = max(1, int(os.environ.get('WEB_CONCURRENCY', 2)))
+WORKER_THREADS = max(1, int(os.environ.get('GUNICORN_THREADS', 4)))
+
+# ルート分類ごとのレート制限（1秒あたりの補充量, バケット容量）
+# login は全ワーカー合計の値（各ワーカーにはワーカー数で割って割り当てる）
+# image は一覧表示でサムネイルをまとめて読むため別枠にする（<img>は再試行しない）
+RATE_LIMITS = {
+    'login': (_env_float('RATE_LIMIT_LOGIN_PER_SEC', 5 / 60) / WEB_CONCURRENCY,
+              max(1, _env_float('RATE_LIMIT_LOGIN_BURST', 5) / WEB_CONCURRENCY)),
+    'write': (_env_float('RATE_LIMIT_WRITE_PER_SEC', 5), _env_float('RATE_LIMIT_WRITE_BURST', 20)),
+    'read': (_env_float('RATE_LIMIT_READ_PER_SEC', 10), _env_float('RATE_LIMIT_READ_BURST', 40)),
+    'image': (_env_float('RATE_LIMIT_IMAGE_PER_SEC', 50), _env_float('RATE_LIMIT_IMAGE_BURST', 300)),
+}
+
+# DB負荷の高いルートの同時実行数・待ち行列の上限（ワーカーごと）
+# 同時実行数はスレッド数より小さくしないと待ち行列・503に到達しないため、既定はスレッド数-1
+DB_MAX_CONCURRENT = int(os.environ.get('DB_MAX_CONCURRENT', max(1, WORKER_THREADS - 1)))
+DB_MAX_QUEUE = int(os.environ.get('DB_MAX_QUEUE', WORKER_THREADS))
+DB_QUEUE_TIMEOUT = _env_float('DB_QUEUE_TIMEOUT', 5)
+
+# 保持するバケット数の上限（古いものから破棄）
+MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 10000))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # トークンを1つ消費する。不足している場合は次のトークンまでの秒数を返す
+    def consume(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, max_buckets=MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # 許可されれば0、制限される場合は再試行までの秒数を返す
+    def check(self, route_class, key):
+        rate, capacity = self.limits[route_class]
+        bucket_key = (route_class, key)
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = TokenBucket(rate, capacity)
+                self._buckets[bucket_key] = bucket
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(bucket_key)
+            return bucket.consume()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent=DB_MAX_CONCURRENT, max_queue=DB_MAX_QUEUE,
+                 queue_timeout=DB_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+
+    # 実行枠を確保する。待ち行列が満杯、または待ち時間切れの場合はFalse
+    def acquire(self):
+        if self._semaphore.acquire(blocking=False):
+            with self._lock:
+                self.active += 1
+            return True
+
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+        try:
+            acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if acquired:
+            with self._lock:
+                self.active += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._semaphore.release()
+
+
+# レート制限・同時実行制限・受付/拒否カウンタをまとめたもの
+class AdmissionController:
+    def __init__(self):
+        self.rate_limiter = RateLimiter()
+        self.db_limiter = ConcurrencyLimiter()
+        self._lock = threading.Lock()
+        self.accepted = {}
+        self.shed = {}
+
+    def _count(self, counter, route_class, reason=None):
+        key = f'{route_class}:{reason}' if reason else route_class
+        with self._lock:
+            counter[key] = counter.get(key, 0) + 1
+
+    # リクエストを受け付けるか判定する
+    # 戻り値: (許可するか, HTTPステータス, Retry-After秒数)
+    def admit(self, route_class, client_key, db_heavy):
+        wait = self.rate_limiter.check(route_class, client_key)
+        if wait > 0:
+            self._count(self.shed, route_class, 'rate_limited')
+            return False, 429, max(1, math.ceil(wait))
+
+        if db_heavy and not self.db_limiter.acquire():
+            self._count(self.shed, route_class, 'overloaded')
+            return False, 503, max(1, math.ceil(self.db_limiter.queue_timeout))
+
+        self._count(self.accepted, route_class)
+        return True, None, None
+
+    def release(self):
+        self.db_limiter.release()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'accepted': dict(self.accepted),
+                'shed': dict(self.shed),
+                'db_active': self.db_limiter.active,
+                'db_waiting': self.db_limiter.waiting,
+                'db_max_concurrent': self.db_limiter.max_concurrent,
+                'db_max_queue': self.db_limiter.max_queue,
+                'scope': 'per_worker',
+            }
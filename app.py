@@ -1,15 +1,30 @@
-from flask import Flask, request, jsonify, send_from_directory, redirect, session
+from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, session, g
 from flask_cors import CORS
 from flask_session import Session
 import json
 import os
 import sqlite3
-from datetime import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from urllib.parse import urlparse
-from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, quote
 from functools import wraps
+import image_pipeline
+from jobs import JobQueue, JOB_SWEEP_INTERVAL
+from admission import AdmissionController
+from cache import LRUCache
+import history as history_archive
+import rollups
+import overdue
+from scheduler import Scheduler
+from cache_bus import create_bus
+import db_pool
+import credentials
+import hashlib
+
+# コールドスタート計測用の起動時刻
+# gunicornのpreload時はマスターでの読み込み時刻になるため、post_worker_init で mark_worker_started() を呼び直す
+STARTED_AT = time.time()
 
 app = Flask(__name__)
 
@@ -47,12 +62,76 @@ def force_https():
         if request.headers.get('X-Forwarded-Proto') != 'https':
             return redirect(request.url.replace('http://', 'https://'), code=301)
 
+# アドミッション制御（レート制限・DB同時実行数制限）
+admission = AdmissionController()
+
+# レート制限の対象外ルート（DBにアクセスしない軽量なもの）
+ADMISSION_EXEMPT_PATHS = {'/api/test', '/api/metrics', '/api/session/check', '/api/logout', '/api/staff/login'}
+
+# リクエストのルート分類を返す（対象外ならNone）
+def classify_request():
+    path = request.path
+    if not path.startswith('/api/') or request.method == 'OPTIONS':
+        return None
+    if path in ADMISSION_EXEMPT_PATHS:
+        return None
+    if path == '/api/admin/login' or (path == '/api/facilities' and request.method == 'POST'):
+        return 'login'
+    if request.endpoint == 'get_equipment_image':
+        return 'image'
+    if request.method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+# レート制限のキー（ログイン済みならセッション、それ以外はIP）
+# X-Forwarded-Forは末尾（直前のプロキシが付与した値）のみ信頼する
+def client_key(route_class):
+    ip = request.access_route[-1] if request.access_route else request.remote_addr
+    sid = getattr(session, 'sid', None)
+    if route_class != 'login' and sid and session.get('logged_in'):
+        return f'session:{sid}'
+    return f'ip:{ip}'
+
+@app.before_request
+def admission_control():
+    route_class = classify_request()
+    if route_class is None:
+        return None
+    
+    # 認証系はハッシュ計算用の専用プールで制限するため、DBの同時実行枠を占有させない
+    # 画像は変換済みキャッシュから返すことが多く、503を返すと<img>が壊れたままになるため対象外
+    db_heavy = route_class in ('read', 'write')
+    allowed, status, retry_after = admission.admit(route_class, client_key(route_class), db_heavy=db_heavy)
+    if not allowed:
+        if status == 429:
+            message = 'リクエストが多すぎます。しばらくしてから再試行してください'
+        else:
+            message = 'サーバーが混雑しています。しばらくしてから再試行してください'
+        response = jsonify({'success': False, 'message': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    g.admission_slot = db_heavy
+    return None
+
+@app.teardown_request
+def release_admission(exc):
+    if g.pop('admission_slot', False):
+        admission.release()
+
+# パスワードハッシュ用プールが満杯の場合の応答
+def hash_pool_busy_response():
+    response = jsonify({'success': False, 'message': '認証処理が混雑しています。しばらくしてから再試行してください'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(credentials.HASH_QUEUE_TIMEOUT)))
+    return response
+
 # データベース接続のヘルパー関数
 def get_db_connection():
     try:
         if DATABASE_URL:
-            # PostgreSQL接続
-            conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+            # PostgreSQL接続（ワーカーごとの接続プールから借りる。close()で返却される）
+            conn = db_pool.get_pool(DATABASE_URL).connect()
         else:
             # ローカル開発用（SQLiteフォールバック）
             conn = sqlite3.connect('equipment.db')
@@ -62,12 +141,57 @@ def get_db_connection():
         print(f"データベース接続エラー: {e}")
         return None
 
+# スキーマのバージョン（テーブル・インデックスを変更したら上げる）
+SCHEMA_VERSION = 3
+
+# 既存テーブルにカラムを追加する（既にあれば何もしない）
+def add_column(cursor, table, column, definition):
+    if DATABASE_URL:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# image_hash が未設定の画像にハッシュを設定する（image_hash 追加前のデータ用）
+def fill_image_hashes(cursor):
+    ph = '%s' if DATABASE_URL else '?'
+    cursor.execute("SELECT id FROM equipment WHERE image_hash IS NULL AND image IS NOT NULL AND image <> ''")
+    for row in cursor.fetchall():
+        cursor.execute(f'SELECT image FROM equipment WHERE id = {ph}', (row['id'],))
+        image = cursor.fetchone()['image']
+        cursor.execute(f'UPDATE equipment SET image_hash = {ph} WHERE id = {ph}',
+                       (image_pipeline.image_key(image), row['id']))
+
+# 保存する画像のハッシュ（画像なしはNone）
+def image_hash_for(data_url):
+    return image_pipeline.image_key(data_url) if data_url else None
+
+# 記録済みのスキーマバージョンを返す（未作成ならNone）
+def get_schema_version(cursor):
+    try:
+        cursor.execute('SELECT version FROM schema_version WHERE id = 1')
+        row = cursor.fetchone()
+        return row['version'] if row else None
+    except Exception:
+        return None
+
 # データベース初期化（PostgreSQL版）
-def init_db():
+# スキーマバージョンが一致していればDDLを省略する（force=Trueで常に実行）
+def init_db(force=False):
+    conn = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
+        if not force and get_schema_version(cursor) == SCHEMA_VERSION:
+            cursor.close()
+            conn.close()
+            print("データベースは最新です（初期化を省略）")
+            return True
+        # PostgreSQLでは失敗したSELECTでトランザクションが中断されるため戻しておく
+        conn.rollback()
+        
         if DATABASE_URL:
             # PostgreSQL用のテーブル作成
             cursor.execute('''
@@ -153,21 +277,10 @@ def init_db():
                     UNIQUE(facility_id, username)
                 )
             ''')
-            # 既存のequipmentテーブルにfacility_idカラムを追加
-        try:
-            if DATABASE_URL:
-                cursor.execute('''
-                    ALTER TABLE equipment 
-                    ADD COLUMN facility_id INTEGER REFERENCES facilities(id) ON DELETE CASCADE
-                ''')
-            else:
-                cursor.execute('''
-                    ALTER TABLE equipment 
-                    ADD COLUMN facility_id INTEGER
-                ''')
-        except Exception as e:
-            # カラムが既に存在する場合はエラーを無視
-            print(f"facility_idカラム追加スキップ: {e}")
+        # 既存のequipmentテーブルにfacility_idカラムを追加
+        # PostgreSQLでは失敗したALTERでトランザクション全体が中断されるため、例外を握りつぶさず存在確認付きで追加する
+        add_column(cursor, 'equipment', 'facility_id',
+                   'INTEGER REFERENCES facilities(id) ON DELETE CASCADE' if DATABASE_URL else 'INTEGER')
 # 管理者パスワードテーブルを追加
         if DATABASE_URL:
             cursor.execute('''
@@ -188,29 +301,307 @@ def init_db():
                 )
             ''')
         
-        # デフォルト管理者アカウントを作成
-        hashed_password = generate_password_hash('admin123')
+        # バックグラウンドジョブテーブルを追加
         if DATABASE_URL:
             cursor.execute('''
-                INSERT INTO admin_users (username, password_hash) 
-                VALUES (%s, %s) 
-                ON CONFLICT (username) DO NOTHING
-            ''', ('admin', hashed_password))
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id VARCHAR(32) PRIMARY KEY,
+                    kind VARCHAR(50) NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    progress INTEGER DEFAULT 0,
+                    total INTEGER,
+                    result TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
         else:
             cursor.execute('''
-                INSERT OR IGNORE INTO admin_users (username, password_hash) 
-                VALUES (?, ?)
-            ''', ('admin', hashed_password))
-
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    progress INTEGER DEFAULT 0,
+                    total INTEGER,
+                    result TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
+        
+        # ジョブを実行しているプロセス（ホスト名:PID）。放棄されたジョブの回収に使う
+        add_column(cursor, 'jobs', 'owner', 'VARCHAR(100)' if DATABASE_URL else 'TEXT')
+        
+        # 画像内容のハッシュ（画像URLのバージョン・派生画像キャッシュのキー）
+        add_column(cursor, 'equipment', 'image_hash', 'VARCHAR(40)' if DATABASE_URL else 'TEXT')
+        fill_image_hashes(cursor)
+        
+        # 履歴アーカイブテーブルを追加
+        if DATABASE_URL:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS history_archive (
+                    id SERIAL PRIMARY KEY,
+                    item_id VARCHAR(50) NOT NULL,
+                    facility_id INTEGER,
+                    entry TEXT NOT NULL,
+                    entry_key VARCHAR(40) NOT NULL,
+                    occurred_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(item_id, entry_key)
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS history_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    item_id TEXT NOT NULL,
+                    facility_id INTEGER,
+                    entry TEXT NOT NULL,
+                    entry_key TEXT NOT NULL,
+                    occurred_at TIMESTAMP,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(item_id, entry_key)
+                )
+            ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_archive_item ON history_archive (item_id, id)')
+        
+        # 利用状況集計テーブルを追加
+        if DATABASE_URL:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_daily (
+                    day VARCHAR(10) NOT NULL,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    category VARCHAR(100) NOT NULL DEFAULT '',
+                    item_id VARCHAR(50) NOT NULL DEFAULT '',
+                    borrow_count INTEGER DEFAULT 0,
+                    return_count INTEGER DEFAULT 0,
+                    total_loan_seconds BIGINT DEFAULT 0,
+                    peak_concurrent INTEGER DEFAULT 0,
+                    PRIMARY KEY (day, facility_id, category, item_id)
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS active_loans (
+                    item_id VARCHAR(50) PRIMARY KEY,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    category VARCHAR(100) NOT NULL,
+                    started_at TIMESTAMP NOT NULL
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_daily (
+                    day TEXT NOT NULL,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    category TEXT NOT NULL DEFAULT '',
+                    item_id TEXT NOT NULL DEFAULT '',
+                    borrow_count INTEGER DEFAULT 0,
+                    return_count INTEGER DEFAULT 0,
+                    total_loan_seconds INTEGER DEFAULT 0,
+                    peak_concurrent INTEGER DEFAULT 0,
+                    PRIMARY KEY (day, facility_id, category, item_id)
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS active_loans (
+                    item_id TEXT PRIMARY KEY,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    category TEXT NOT NULL,
+                    started_at TIMESTAMP NOT NULL
+                )
+            ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_active_loans_facility ON active_loans (facility_id, category)')
+        
+        # 長期貸出（返却遅れ）テーブルと検出用インデックスを追加
+        if DATABASE_URL:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS overdue_loans (
+                    item_id VARCHAR(50) PRIMARY KEY,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    name VARCHAR(200) NOT NULL,
+                    category VARCHAR(100) NOT NULL,
+                    user_location VARCHAR(100) DEFAULT '',
+                    since TIMESTAMP NOT NULL,
+                    threshold_hours REAL NOT NULL,
+                    elapsed_hours REAL NOT NULL,
+                    detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS overdue_loans (
+                    item_id TEXT PRIMARY KEY,
+                    facility_id INTEGER NOT NULL DEFAULT 0,
+                    name TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    user_location TEXT DEFAULT '',
+                    since TIMESTAMP NOT NULL,
+                    threshold_hours REAL NOT NULL,
+                    elapsed_hours REAL NOT NULL,
+                    detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_overdue_loans_facility ON overdue_loans (facility_id)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_equipment_facility_status_updated
+            ON equipment (facility_id, status, updated_at)
+        ''')
+        
+        # 一覧（登録日時の新しい順）と施設リスト（名前順）の並べ替え用インデックス
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_equipment_created_at ON equipment (created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_facilities_name ON facilities (name)')
+        
+        # ワーカー間のキャッシュ無効化用カウンタ（SQLiteのみ。PostgreSQLはLISTEN/NOTIFYを使う）
+        if not DATABASE_URL:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    topic TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+        
+        # デフォルト管理者アカウントを作成（ハッシュ計算は重いため未作成の場合のみ）
+        ph = '%s' if DATABASE_URL else '?'
+        cursor.execute(f'SELECT 1 FROM admin_users WHERE username = {ph}', ('admin',))
+        if cursor.fetchone() is None:
+            hashed_password = credentials.hash_password('admin123')
+            if DATABASE_URL:
+                cursor.execute('''
+                    INSERT INTO admin_users (username, password_hash) 
+                    VALUES (%s, %s) 
+                    ON CONFLICT (username) DO NOTHING
+                ''', ('admin', hashed_password))
+            else:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO admin_users (username, password_hash) 
+                    VALUES (?, ?)
+                ''', ('admin', hashed_password))
+        
+        # スキーマバージョンを記録
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute(f'''
+            INSERT INTO schema_version (id, version) VALUES (1, {ph})
+            ON CONFLICT (id) DO UPDATE SET version = excluded.version, updated_at = CURRENT_TIMESTAMP
+        ''', (SCHEMA_VERSION,))
         
         conn.commit()
         cursor.close()
         conn.close()
         print("データベース初期化完了")
+        return True
     except Exception as e:
         print(f"データベース初期化エラー: {e}")
         if conn:
             conn.close()
+        return False
+
+# バックグラウンドジョブキュー
+job_queue = JobQueue(get_db_connection, use_postgres=bool(DATABASE_URL))
+
+# 定期実行ジョブ
+scheduler = Scheduler()
+scheduler.add_job('overdue-scan', overdue.SCAN_INTERVAL,
+                  lambda: overdue.scan_all(get_db_connection, bool(DATABASE_URL)))
+scheduler.add_job('job-sweep', JOB_SWEEP_INTERVAL, job_queue.sweep)
+scheduler.add_job('image-cache-prune', image_pipeline.IMAGE_CACHE_PRUNE_INTERVAL, image_pipeline.prune_cache)
+
+# ワーカー間のキャッシュ無効化通知（LISTEN用の接続はプールから借りずに専用で張る）
+cache_bus = create_bus(get_db_connection, use_postgres=bool(DATABASE_URL),
+                       listen_connection=lambda: db_pool.connect_direct(DATABASE_URL))
+
+# 起動状態（/ready と /api/metrics で返す）
+startup_state = {
+    'ready': False,
+    'warmup_seconds': None,
+    'ready_after_seconds': None,
+    'first_request_after_seconds': None,
+    'warmup_failures': 0,
+}
+_warm_up_lock = threading.Lock()
+_warm_up_failed_at = None
+
+# ウォームアップに失敗した後、リクエスト契機で再試行するまでの間隔（秒）
+WARM_UP_RETRY_INTERVAL = float(os.environ.get('WARM_UP_RETRY_INTERVAL', 5))
+
+# ワーカーの起動時刻を記録し直す（gunicorn.conf.py の post_worker_init から呼ばれる）
+def mark_worker_started():
+    global STARTED_AT
+    STARTED_AT = time.time()
+
+# 接続プールとキャッシュを温めてから準備完了にする
+# gunicornでは post_worker_init（gunicorn.conf.py）から、それ以外は最初のリクエストで呼ばれる
+# blocking=False の場合、他のスレッドが実行中なら待たずにFalseを返す
+def warm_up(blocking=True):
+    global _warm_up_failed_at
+    if not _warm_up_lock.acquire(blocking=blocking):
+        return False
+    try:
+        if startup_state['ready']:
+            return True
+        begin = time.monotonic()
+        try:
+            conn = get_db_connection()
+            if conn is None:
+                raise RuntimeError('データベースに接続できません')
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            conn.close()
+            with app.app_context():
+                get_facilities()
+            # 前回のプロセスが終了した時点で実行中だったジョブを失敗にする
+            job_queue.reap_orphans()
+            start_background_services()
+        except Exception as e:
+            print(f"ウォームアップエラー: {e}")
+            _warm_up_failed_at = time.monotonic()
+            startup_state['warmup_failures'] += 1
+            return False
+        startup_state['warmup_seconds'] = round(time.monotonic() - begin, 3)
+        startup_state['ready_after_seconds'] = round(time.time() - STARTED_AT, 3)
+        startup_state['ready'] = True
+        print(f"ウォームアップ完了 ({startup_state['warmup_seconds']}秒)")
+        return True
+    finally:
+        _warm_up_lock.release()
+
+# 未完了なら再試行する。DB停止中などで失敗が続く場合に全リクエストがロック待ちで
+# 直列化しないよう、失敗後は WARM_UP_RETRY_INTERVAL 秒空け、実行中のスレッドがあれば待たない
+@app.before_request
+def ensure_warm():
+    if request.path in ('/ready', '/health'):
+        return
+    if not startup_state['ready']:
+        failed_at = _warm_up_failed_at
+        if failed_at is None or time.monotonic() - failed_at >= WARM_UP_RETRY_INTERVAL:
+            warm_up(blocking=False)
+    if startup_state['first_request_after_seconds'] is None:
+        startup_state['first_request_after_seconds'] = round(time.time() - STARTED_AT, 3)
+
+# スケジューラ・通知受信スレッドはフォーク後のワーカーで起動する必要があるため、
+# ウォームアップ時と各リクエストで確認する
+@app.before_request
+def start_background_services():
+    if not scheduler.running and os.environ.get('SCHEDULER_ENABLED', '1') == '1':
+        scheduler.start()
+    try:
+        cache_bus.start()
+        cache_bus.poll()
+    except Exception as e:
+        print(f"キャッシュ通知の確認エラー: {e}")
 
 # 静的ファイル配信
 @app.route('/')
@@ -240,64 +631,423 @@ def test_api():
         'database': db_status
     })
 
+# 運用メトリクス
+@app.route('/api/metrics')
+def metrics():
+    return jsonify({
+        'admission': admission.snapshot(),
+        'item_cache': equipment_item_cache.stats(),
+        'scheduler': scheduler.stats(),
+        'cache_bus': cache_bus.stats(),
+        'db_pool': db_pool.pool_stats(),
+        'startup': startup_state,
+        'password_hash': credentials.stats()
+    })
+
+# 準備完了確認（ウォームアップ前は503。/health はプロセスの生存確認のみ）
+@app.route('/ready')
+def readiness_check():
+    status = 200 if startup_state['ready'] else 503
+    return jsonify({'pid': os.getpid(), **startup_state}), status
+
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
 
 # 全備品データ取得
+# ?fields= / ?exclude= で返すフィールドを絞り込める（SELECT句にも反映される）
 @app.route('/api/equipment', methods=['GET'])
 def get_equipment():
+    conn = None
+    try:
+        fields = resolve_fields(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         conn = get_db_connection()
         if conn is None:
             return jsonify({'error': 'データベース接続失敗'}), 500
             
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM equipment ORDER BY created_at DESC')
+        cursor.execute(f'SELECT {", ".join(select_columns(fields))} FROM equipment ORDER BY created_at DESC')
+        rows = cursor.fetchall()
         
-        if DATABASE_URL:
-            # PostgreSQL
-            rows = cursor.fetchall()
+        equipment_list = [equipment_to_dict(row, fields) for row in rows]
+        
+        cursor.close()
+        conn.close()
+        return jsonify(equipment_list)
+        
+    except Exception as e:
+        print(f"備品データ取得エラー: {e}")
+        if conn:
+            conn.close()
+        return jsonify({'error': 'データ取得に失敗しました', 'details': str(e)}), 500
+
+# 備品画像（サイズ別）取得
+# 派生画像は初回アクセス時に生成してディスクにキャッシュする
+@app.route('/api/equipment/<item_id>/image/<size>', methods=['GET'])
+def get_equipment_image(item_id, size):
+    if size not in image_pipeline.IMAGE_SIZES:
+        return jsonify({'success': False, 'message': '無効な画像サイズです'}), 404
+    
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
+        
+        # まずハッシュだけを読み、304やキャッシュ済みの派生画像で済む場合は画像本体を読まない
+        ph = '%s' if DATABASE_URL else '?'
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT image_hash, {HAS_IMAGE_COLUMN} FROM equipment WHERE item_id = {ph}', (item_id,))
+        row = cursor.fetchone()
+        if not row or not row['has_image']:
+            cursor.close()
+            conn.close()
+            return jsonify({'success': False, 'message': '画像が見つかりません'}), 404
+        
+        key = row['image_hash']
+        path = None
+        if key:
+            etag = f'{key}-{size}'
+            if request.if_none_match.contains(etag):
+                cursor.close()
+                conn.close()
+                return '', 304, {'ETag': f'"{etag}"'}
+            path = image_pipeline.cached_variant_path(key, size)
+        
+        image = None
+        if path is None:
+            cursor.execute(f'SELECT image FROM equipment WHERE item_id = {ph}', (item_id,))
+            image = cursor.fetchone()['image']
+        cursor.close()
+        conn.close()
+        conn = None
+        
+        if path is None:
+            key = image_pipeline.image_key(image)
+            etag = f'{key}-{size}'
+            if request.if_none_match.contains(etag):
+                return '', 304, {'ETag': f'"{etag}"'}
+            path = image_pipeline.get_variant_path(image, size)
+        response = send_file(os.path.abspath(path), mimetype='image/jpeg', conditional=False)
+        response.set_etag(etag)
+        # URLにバージョンが付いている場合は長期キャッシュを許可
+        if request.args.get('v'):
+            response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
         else:
-            # SQLite
-            rows = cursor.fetchall()
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
-        equipment_list = []
-        for row in rows:
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 422
+    except Exception as e:
+        if conn:
+            conn.close()
+        print(f"画像取得エラー: {e}")
+        return jsonify({'success': False, 'message': '画像の取得に失敗しました'}), 500
+
+# 一覧表示用の派生画像URL（画像内容のハッシュをバージョンとしてブラウザキャッシュを効かせる）
+# 貸出・返却などで画像以外が更新されてもURLは変わらない
+# has_image列が選択されていれば画像本体を読まずに判定する
+def image_variant_url(row, size):
+    has_image = row['has_image'] if 'has_image' in row.keys() else row['image']
+    if not has_image:
+        return ''
+    url = f"/api/equipment/{quote(row['item_id'])}/image/{size}"
+    version = row['image_hash'] if 'image_hash' in row.keys() else None
+    return f'{url}?v={version}' if version else url
+
+# APIのフィールド名と、その値を作るのに必要なDBカラム
+EQUIPMENT_FIELDS = {
+    'name': ('name',),
+    'id': ('item_id',),
+    'location': ('location',),
+    'category': ('category',),
+    'current': ('current_location',),
+    'user': ('user_location',),
+    'status': ('status',),
+    'note': ('note',),
+    'image': ('image',),
+    'thumbnail': ('has_image', 'image_hash'),
+    'history': ('history',),
+    'createdAt': ('created_at',),
+}
+
+# 画像本体を転送せずに画像の有無だけを取得する式
+HAS_IMAGE_COLUMN = "CASE WHEN image IS NULL OR image = '' THEN 0 ELSE 1 END AS has_image"
+
+# よく使う表示用のフィールドセット
+FIELD_PRESETS = {
+    'summary': ('name', 'id', 'status'),
+    'card': ('name', 'id', 'location', 'category', 'current', 'user', 'status', 'note', 'thumbnail'),
+    'full': tuple(EQUIPMENT_FIELDS),
+}
+
+def _split_fields(value):
+    requested = []
+    for field in value.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        if field in FIELD_PRESETS:
+            requested.extend(FIELD_PRESETS[field])
+        elif field in EQUIPMENT_FIELDS:
+            requested.append(field)
+        else:
+            raise ValueError(f'無効なフィールドです: {field}')
+    return requested
+
+# ?fields= の値を検証し、APIフィールド名のリストを返す（未指定なら全フィールド）
+# プリセット名（summary, card, full）とフィールド名を混在して指定できる
+def parse_fields(value, exclude=None):
+    requested = _split_fields(value) if value else list(EQUIPMENT_FIELDS)
+    excluded = _split_fields(exclude) if exclude else []
+    return [field for field in EQUIPMENT_FIELDS if field in requested and field not in excluded]
+
+def resolve_fields(args):
+    return parse_fields(args.get('fields'), args.get('exclude'))
+
+# 指定フィールドに必要なSELECT句のカラム一覧
+def select_columns(fields):
+    columns = ['item_id']
+    for field in fields:
+        for column in EQUIPMENT_FIELDS[field]:
+            if column not in columns:
+                columns.append(column)
+    return [HAS_IMAGE_COLUMN if column == 'has_image' else column for column in columns]
+
+# DBの行をAPIレスポンス用の辞書に変換（指定フィールドのみ）
+def equipment_to_dict(row, fields):
+    equipment = {}
+    for field in fields:
+        if field == 'history':
             try:
-                history_data = json.loads(row['history']) if row['history'] else []
+                equipment['history'] = json.loads(row['history']) if row['history'] else []
             except:
-                history_data = []
-                
-            equipment = {
-                'name': row['name'],
-                'id': row['item_id'],
-                'location': row['location'],
-                'category': row['category'],
-                'current': row['current_location'] or '',
-                'user': row['user_location'] or '',
-                'status': row['status'],
-                'note': row['note'] or '',
-                'image': row['image'] or '',
-                'history': history_data,
-                'createdAt': row['created_at'].isoformat() if hasattr(row['created_at'], 'isoformat') else str(row['created_at'])
+                equipment['history'] = []
+        elif field == 'thumbnail':
+            equipment['thumbnail'] = image_variant_url(row, 'thumb')
+        elif field == 'createdAt':
+            created_at = row['created_at']
+            equipment['createdAt'] = created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at)
+        elif field in ('id', 'status'):
+            equipment[field] = row[EQUIPMENT_FIELDS[field][0]]
+        else:
+            equipment[field] = row[EQUIPMENT_FIELDS[field][0]] or ''
+    return equipment
+
+# 単品取得用キャッシュ（QR/バーコード読み取り時の高速化）
+# 書き込み系ルートで該当備品のエントリを破棄する
+ITEM_CACHE_MAX_ENTRY_BYTES = 64 * 1024
+equipment_item_cache = LRUCache(
+    maxsize=int(os.environ.get('ITEM_CACHE_SIZE', 512)),
+    max_bytes=int(os.environ.get('ITEM_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+    ttl=float(os.environ.get('ITEM_CACHE_TTL', 30))
+)
+
+def discard_equipment_cache(item_id=None):
+    if item_id is None:
+        equipment_item_cache.clear()
+    else:
+        equipment_item_cache.discard_if(lambda key: key[0] == item_id)
+
+# 自ワーカーのキャッシュを破棄し、他ワーカーにも通知する
+def invalidate_equipment_cache(item_id=None):
+    discard_equipment_cache(item_id)
+    try:
+        cache_bus.publish('equipment', item_id)
+    except Exception as e:
+        print(f"キャッシュ無効化通知エラー: {e}")
+
+cache_bus.subscribe('equipment', discard_equipment_cache)
+
+# 長期貸出（返却遅れ）一覧
+# 定期スキャンの結果を返す。?refresh=1 で即時に再検出する（facility_id指定時はその施設のみ）
+@app.route('/api/equipment/overdue', methods=['GET'])
+def get_overdue_equipment():
+    conn = None
+    facility_id = parse_facility_id(request.args.get('facility_id'))
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
+        
+        cursor = conn.cursor()
+        if request.args.get('refresh') == '1':
+            if facility_id is None:
+                overdue.scan_all(get_db_connection, bool(DATABASE_URL))
+            else:
+                overdue.scan_facility(cursor, bool(DATABASE_URL), facility_id)
+                conn.commit()
+        results = overdue.fetch(cursor, bool(DATABASE_URL), facility_id)
+        cursor.close()
+        conn.close()
+        return jsonify({
+            'success': True,
+            'overdue': results,
+            'thresholds': {
+                'default': overdue.DEFAULT_THRESHOLD_HOURS,
+                'categories': overdue.CATEGORY_THRESHOLD_HOURS
             }
-            equipment_list.append(equipment)
+        })
         
+    except Exception as e:
+        if conn:
+            conn.rollback()
+            conn.close()
+        print(f"返却遅れ取得エラー: {e}")
+        return jsonify({'success': False, 'message': '返却遅れの取得に失敗しました'}), 500
+
+# 備品1件取得（item_idで検索、facility_id指定時は施設も一致するもののみ）
+# ?fields= / ?exclude= は一覧取得と同じ形式
+@app.route('/api/equipment/<item_id>', methods=['GET'])
+def get_equipment_item(item_id):
+    conn = None
+    try:
+        fields = resolve_fields(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    facility_id = parse_facility_id(request.args.get('facility_id'))
+    if facility_id is None and (request.args.get('facility_id') or '').strip():
+        return jsonify({'success': False, 'message': '無効な施設IDです'}), 400
+    
+    try:
+        cache_key = (item_id, facility_id, tuple(fields))
+        body = equipment_item_cache.get(cache_key)
+        
+        if body is None:
+            # 読み込み中に更新・無効化された場合は古い内容をキャッシュしない
+            generation = equipment_item_cache.generation()
+            conn = get_db_connection()
+            if conn is None:
+                return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
+            
+            param_placeholder = '%s' if DATABASE_URL else '?'
+            query = f'SELECT {", ".join(select_columns(fields))} FROM equipment WHERE item_id = {param_placeholder}'
+            params = [item_id]
+            if facility_id:
+                query += f' AND facility_id = {param_placeholder}'
+                params.append(facility_id)
+            
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            cursor.close()
+            conn.close()
+            conn = None
+            
+            if not row:
+                return jsonify({'success': False, 'message': '備品が見つかりません'}), 404
+            
+            body = json.dumps(equipment_to_dict(row, fields), ensure_ascii=False).encode('utf-8')
+            if len(body) <= ITEM_CACHE_MAX_ENTRY_BYTES:
+                equipment_item_cache.set(cache_key, body, generation)
+        
+        etag = hashlib.sha1(body).hexdigest()
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': f'"{etag}"'}
+        
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        print(f"備品取得エラー: {e}")
+        return jsonify({'success': False, 'message': 'データ取得に失敗しました'}), 500
+
+# アーカイブ済み履歴の取得（新しい順、ページ単位）
+@app.route('/api/equipment/<item_id>/history/archive', methods=['GET'])
+def get_history_archive(item_id):
+    conn = None
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(200, max(1, int(request.args.get('per_page', 50))))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'ページ指定が不正です'}), 400
+    
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
+        
+        cursor = conn.cursor()
+        entries, total = history_archive.fetch_archive(cursor, bool(DATABASE_URL), item_id, page, per_page)
         cursor.close()
         conn.close()
-        return jsonify(equipment_list)
+        return jsonify({
+            'success': True,
+            'entries': entries,
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'has_more': page * per_page < total
+        })
         
     except Exception as e:
-        print(f"備品データ取得エラー: {e}")
         if conn:
             conn.close()
-        return jsonify({'error': 'データ取得に失敗しました', 'details': str(e)}), 500
+        print(f"履歴アーカイブ取得エラー: {e}")
+        return jsonify({'success': False, 'message': '履歴の取得に失敗しました'}), 500
+
+# 利用状況分析（日次集計テーブルから集計する）
+# ?group=facility|category|item&from=YYYY-MM-DD&to=YYYY-MM-DD&facility_id=
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    conn = None
+    group_by = request.args.get('group', 'category')
+    if group_by not in ('facility', 'category', 'item'):
+        return jsonify({'success': False, 'message': '無効な集計単位です'}), 400
+    try:
+        # 期間の日付は画面のタイムゾーンで数える
+        today = history_archive.utc_to_client(history_archive.utc_now()).date()
+        date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else today
+        date_from = (datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+                     if request.args.get('from') else date_to - timedelta(days=29))
+    except ValueError:
+        return jsonify({'success': False, 'message': '日付はYYYY-MM-DD形式で指定してください'}), 400
+    facility_id = parse_facility_id(request.args.get('facility_id'))
+    
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
+        
+        cursor = conn.cursor()
+        results = rollups.query(
+            cursor, bool(DATABASE_URL), group_by,
+            date_from.isoformat(), date_to.isoformat(), facility_id
+        )
+        cursor.close()
+        conn.close()
+        return jsonify({
+            'success': True,
+            'group': group_by,
+            'from': date_from.isoformat(),
+            'to': date_to.isoformat(),
+            'results': results
+        })
+        
+    except Exception as e:
+        if conn:
+            conn.close()
+        print(f"分析データ取得エラー: {e}")
+        return jsonify({'success': False, 'message': '分析データの取得に失敗しました'}), 500
 
 # 施設リスト取得API (新規追加)
 @app.route('/api/facilities', methods=['GET'])
 def get_facilities():
+    facilities = facilities_cache.get('all')
+    if facilities is not None:
+        return jsonify({'success': True, 'facilities': facilities})
+    
     conn = None
+    generation = facilities_cache.generation()
     try:
         conn = get_db_connection()
         if conn is None:
@@ -324,6 +1074,7 @@ def get_facilities():
         
         cursor.close()
         conn.close()
+        facilities_cache.set('all', facilities, generation)
         return jsonify({'success': True, 'facilities': facilities})
         
     except Exception as e:
@@ -332,6 +1083,17 @@ def get_facilities():
         print(f"施設リスト取得エラー: {e}")
         return jsonify({'success': False, 'message': '施設リストの取得に失敗しました'}), 500
 
+# 施設リストのキャッシュ（ログイン画面で毎回読まれるため）
+facilities_cache = LRUCache(maxsize=1, ttl=float(os.environ.get('FACILITIES_CACHE_TTL', 300)))
+cache_bus.subscribe('facilities', lambda key: facilities_cache.clear())
+
+def invalidate_facilities_cache():
+    facilities_cache.clear()
+    try:
+        cache_bus.publish('facilities')
+    except Exception as e:
+        print(f"キャッシュ無効化通知エラー: {e}")
+
 @app.route('/api/equipment', methods=['POST'])
 def create_equipment():
     # 管理者権限チェック
@@ -363,6 +1125,12 @@ def create_equipment():
             'history': data.get('history', [])
         }
         
+        # 画像はサーバー側で検証・再エンコードしてから保存する
+        try:
+            sanitized_data['image'] = image_pipeline.normalize_upload(sanitized_data['image'])
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        
         conn = get_db_connection()
         if conn is None:
             return jsonify({'success': False, 'message': 'データベース接続失敗'}), 500
@@ -372,33 +1140,37 @@ def create_equipment():
         if DATABASE_URL:
             cursor.execute('''
                 INSERT INTO equipment (
-                    item_id, name, location, category, image, history
-                ) VALUES (%s, %s, %s, %s, %s, %s)
+                    item_id, name, location, category, image, image_hash, history
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s)
             ''', (
                 sanitized_data['id'],
                 sanitized_data['name'],
                 sanitized_data['location'],
                 sanitized_data['category'],
                 sanitized_data['image'],
+                image_hash_for(sanitized_data['image']),
                 json.dumps(sanitized_data['history'])
             ))
         else:
             cursor.execute('''
                 INSERT INTO equipment (
-                    item_id, name, location, category, image, history
-                ) VALUES (?, ?, ?, ?, ?, ?)
+                    item_id, name, location, category, image, image_hash, history
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
                 sanitized_data['id'],
                 sanitized_data['name'],
                 sanitized_data['location'],
                 sanitized_data['category'],
                 sanitized_data['image'],
+                image_hash_for(sanitized_data['image']),
                 json.dumps(sanitized_data['history'])
             ))
         
         conn.commit()
         cursor.close()
         conn.close()
+        invalidate_equipment_cache(sanitized_data['id'])
+        image_pipeline.prefetch_variants(sanitized_data['image'])
         return jsonify({'success': True, 'message': '備品が登録されました'})
         
     except Exception as e:
@@ -458,6 +1230,13 @@ def update_equipment(item_id):
                 'message': '入力エラー: ' + ', '.join(errors)
             }), 400
         
+        # 画像が送信されている場合はサーバー側で検証・再エンコード
+        if 'image' in data:
+            try:
+                data['image'] = image_pipeline.normalize_upload(data['image'])
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         # 安全なフィールドマッピングを追加
@@ -486,8 +1265,13 @@ def update_equipment(item_id):
         for field_key, db_column in safe_fields.items():
             if field_key in data:
                 if field_key == 'history':
+                    # 古い履歴は行内に残さずアーカイブへ移す
+                    keep, old_entries = history_archive.split_history(data[field_key])
+                    history_archive.archive_entries(
+                        cursor, bool(DATABASE_URL), item_id, parse_facility_id(data.get('facility_id')), old_entries
+                    )
                     update_fields.append(f'{db_column} = {param_placeholder}')
-                    values.append(json.dumps(data[field_key]))
+                    values.append(json.dumps(keep))
                 elif field_key == 'facility_id':
                     # facility_idは整数型に変換
                     try:
@@ -502,21 +1286,45 @@ def update_equipment(item_id):
                     update_fields.append(f'{db_column} = {param_placeholder}')
                     values.append(data[field_key])
 
+        if 'image' in data:
+            update_fields.append(f'image_hash = {param_placeholder}')
+            values.append(image_hash_for(data['image']))
+        
         # updated_atを追加
         update_fields.append('updated_at = CURRENT_TIMESTAMP')
         values.append(item_id)
         
         query = f'UPDATE equipment SET {", ".join(update_fields)} WHERE item_id = {param_placeholder}'
         
+        # 貸出・返却の集計用に更新前の状態を取得
+        previous = None
+        if 'status' in data:
+            cursor.execute(
+                f'SELECT status, category, facility_id FROM equipment WHERE item_id = {param_placeholder}',
+                (item_id,)
+            )
+            previous = cursor.fetchone()
+        
         cursor.execute(query, values)
         
         if cursor.rowcount == 0:
             conn.close()
             return jsonify({'success': False, 'message': '備品が見つかりません'}), 404
         
+        if previous:
+            rollups.record_status_change(
+                cursor, bool(DATABASE_URL), item_id,
+                parse_facility_id(data.get('facility_id')) or previous['facility_id'],
+                data.get('category') or previous['category'],
+                previous['status'], data['status']
+            )
+        
         conn.commit()
         cursor.close()
         conn.close()
+        invalidate_equipment_cache(item_id)
+        if data.get('image'):
+            image_pipeline.prefetch_variants(data['image'])
         return jsonify({'success': True, 'message': '備品情報が更新されました'})
         
     except Exception as e:
@@ -548,9 +1356,18 @@ def delete_equipment(item_id):
             conn.close()
             return jsonify({'success': False, 'message': '備品が見つかりません'}), 404
         
+        # アーカイブ済みの履歴・貸出中の記録も削除
+        if DATABASE_URL:
+            cursor.execute('DELETE FROM history_archive WHERE item_id = %s', (item_id,))
+            cursor.execute('DELETE FROM active_loans WHERE item_id = %s', (item_id,))
+        else:
+            cursor.execute('DELETE FROM history_archive WHERE item_id = ?', (item_id,))
+            cursor.execute('DELETE FROM active_loans WHERE item_id = ?', (item_id,))
+        
         conn.commit()
         cursor.close()
         conn.close()
+        invalidate_equipment_cache(item_id)
         return jsonify({'success': True, 'message': '備品が削除されました'})
         
     except Exception as e:
@@ -578,6 +1395,12 @@ def create_facility():
         if not facility_name or not admin_password:
             return jsonify({'success': False, 'message': '施設名と管理者パスワードは必須です'}), 400
         
+        # ハッシュ計算中にDB接続を保持しないよう、接続前に計算する
+        try:
+            hashed_password = credentials.hash_password(admin_password)
+        except credentials.HashPoolBusy:
+            return hash_pool_busy_response()
+        
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -596,7 +1419,6 @@ def create_facility():
             facility_id = cursor.lastrowid
         
         # 管理者ユーザーを作成
-        hashed_password = generate_password_hash(admin_password)
         if DATABASE_URL:
             cursor.execute('''
                 INSERT INTO users (facility_id, username, password_hash, role) 
@@ -611,6 +1433,7 @@ def create_facility():
         conn.commit()
         cursor.close()
         conn.close()
+        invalidate_facilities_cache()
         return jsonify({'success': True, 'message': '施設が登録されました', 'facility_id': facility_id})
         
     except Exception as e:
@@ -621,22 +1444,20 @@ def create_facility():
         return jsonify({'success': False, 'message': f'登録に失敗しました: {str(e)}'}), 500
         
 
-# データエクスポート
-@app.route('/api/export', methods=['GET'])
-def export_data():
+# エクスポート用データ作成（ジョブ・同期エンドポイント共通）
+def build_export(job=None):
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
         cursor.execute('SELECT * FROM equipment')
-        
-        if DATABASE_URL:
-            rows = cursor.fetchall()
-        else:
-            rows = cursor.fetchall()
+        rows = cursor.fetchall()
+        # アーカイブ済みの履歴は行内の履歴の前に連結して出力する（インポートで元に戻せるように）
+        archives = history_archive.fetch_all_archives(cursor)
         
         equipment_list = []
-        for row in rows:
+        for index, row in enumerate(rows):
+            if job:
+                job.set_progress(index, len(rows))
             equipment = {
                 'name': row['name'],
                 'id': row['item_id'],
@@ -647,92 +1468,260 @@ def export_data():
                 'status': row['status'],
                 'note': row['note'],
                 'image': row['image'],
-                'history': json.loads(row['history']) if row['history'] else [],
+                'history': archives.get(row['item_id'], []) + (json.loads(row['history']) if row['history'] else []),
                 'createdAt': row['created_at'].isoformat() if hasattr(row['created_at'], 'isoformat') else str(row['created_at'])
             }
             equipment_list.append(equipment)
         
         cursor.close()
+    finally:
         conn.close()
-        return jsonify(equipment_list)
-        
-    except Exception as e:
-        if conn:
-            conn.close()
-        print(f"エクスポートエラー: {e}")
-        return jsonify({'error': 'エクスポートに失敗しました', 'details': str(e)}), 500
+    return equipment_list
 
-# データインポート
-@app.route('/api/import', methods=['POST'])
-def import_data():
-    conn = None
+# インポートデータの取り出しと検証
+# 配列そのもの、または {"data": [...]} 形式を受け付ける
+def extract_import_items(data):
+    if isinstance(data, dict):
+        data = data.get('data')
+    if not isinstance(data, list):
+        raise ValueError('インポートデータは配列で送信してください')
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise ValueError(f'{index + 1}件目のデータが不正です')
+        missing = [key for key in ('id', 'name', 'location', 'category') if not item.get(key)]
+        if missing:
+            raise ValueError(f'{index + 1}件目に必須項目がありません: {", ".join(missing)}')
+    return data
+
+# インポートする画像を検証・再エンコードする（DBのトランザクションを開く前に行う）
+# 読み込めない画像は取り込まず、備品IDとエラー内容を返す
+def normalize_import_images(job, items):
+    images = []
+    rejected = []
+    for index, item in enumerate(items):
+        job.set_progress(index, len(items) * 2)
+        try:
+            images.append(image_pipeline.normalize_upload(item.get('image', '')))
+        except ValueError as e:
+            images.append('')
+            rejected.append({'id': item['id'], 'message': str(e)})
+    return images, rejected
+
+# インポート処理本体（ジョブとして実行）
+# キャンセルされた場合はロールバックして既存データを残す
+def run_import(job, items):
+    images, rejected_images = normalize_import_images(job, items)
+    conn = get_db_connection()
     try:
-        data = request.json
-        conn = get_db_connection()
         cursor = conn.cursor()
         
-        # 既存データを削除
+        # 既存データを削除（アーカイブ済みの履歴・貸出中の記録も置き換える）
         cursor.execute('DELETE FROM equipment')
+        cursor.execute('DELETE FROM history_archive')
+        cursor.execute('DELETE FROM active_loans')
+        
+        if DATABASE_URL:
+            param_placeholder = '%s'
+        else:
+            param_placeholder = '?'
+        placeholders = ', '.join([param_placeholder] * 11)
         
         # 新しいデータを挿入
-        for item in data:
-            if DATABASE_URL:
-                cursor.execute('''
-                    INSERT INTO equipment (
-                        item_id, name, location, category, current_location,
-                        user_location, status, note, image, history
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (
-                    item['id'],
-                    item['name'],
-                    item['location'],
-                    item['category'],
-                    item.get('current', ''),
-                    item.get('user', ''),
-                    item.get('status', '待機'),
-                    item.get('note', ''),
-                    item.get('image', ''),
-                    json.dumps(item.get('history', []))
-                ))
-            else:
-                cursor.execute('''
-                    INSERT INTO equipment (
-                        item_id, name, location, category, current_location,
-                        user_location, status, note, image, history
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id'],
-                    item['name'],
-                    item['location'],
-                    item['category'],
-                    item.get('current', ''),
-                    item.get('user', ''),
-                    item.get('status', '待機'),
-                    item.get('note', ''),
-                    item.get('image', ''),
-                    json.dumps(item.get('history', []))
-                ))
+        for index, item in enumerate(items):
+            job.set_progress(len(items) + index, len(items) * 2)
+            # 古い履歴は登録時と同じ基準でアーカイブへ移す
+            keep, old_entries = history_archive.split_history(item.get('history', []))
+            cursor.execute(f'''
+                INSERT INTO equipment (
+                    item_id, name, location, category, current_location,
+                    user_location, status, note, image, image_hash, history
+                ) VALUES ({placeholders})
+            ''', (
+                item['id'],
+                item['name'],
+                item['location'],
+                item['category'],
+                item.get('current', ''),
+                item.get('user', ''),
+                item.get('status', '待機'),
+                item.get('note', ''),
+                images[index],
+                image_hash_for(images[index]),
+                json.dumps(keep)
+            ))
+            history_archive.archive_entries(cursor, bool(DATABASE_URL), item['id'], None, old_entries)
         
+        job.set_progress(len(items) * 2, len(items) * 2, force=True)
         conn.commit()
         cursor.close()
+        invalidate_equipment_cache()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        return jsonify({'success': True, 'message': 'データがインポートされました'})
-        
+    
+    # 取り込んだ履歴から利用状況集計を作り直す
+    job_queue.submit('analytics-backfill', run_analytics_backfill)
+    return {'imported': len(items), 'rejectedImages': rejected_images}
+
+def run_export(job):
+    return build_export(job)
+
+def run_history_compaction(job):
+    result = history_archive.compact_all(job, get_db_connection, bool(DATABASE_URL))
+    invalidate_equipment_cache()
+    return result
+
+def run_analytics_backfill(job):
+    return rollups.backfill(job, get_db_connection, bool(DATABASE_URL))
+
+def run_init_db(job):
+    if not init_db(force=True):
+        raise RuntimeError('データベース初期化に失敗しました')
+    return {'initialized': True}
+
+# データエクスポート（同期版、互換性のため残す）
+@app.route('/api/export', methods=['GET'])
+def export_data():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        return jsonify(build_export())
     except Exception as e:
-        if conn:
-            conn.rollback()
-            conn.close()
-        print(f"インポートエラー: {e}")
-        return jsonify({'success': False, 'message': f'インポートに失敗しました: {str(e)}'}), 400
+        print(f"エクスポートエラー: {e}")
+        return jsonify({'error': 'エクスポートに失敗しました', 'details': str(e)}), 500
+
+# データインポート（ジョブとして受け付ける）
+@app.route('/api/import', methods=['POST'])
+def import_data():
+    return create_import_job()
 
 # データベース初期化エンドポイント
+# jobsテーブルが未作成の初回のみ同期実行する
 @app.route('/api/init-db')
 def init_database():
     try:
-        init_db()
+        job_id = job_queue.submit('init-db', run_init_db)
+        return jsonify({'status': 'accepted', 'message': 'データベース初期化を開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"初期化ジョブ登録失敗、同期実行します: {e}")
+    try:
+        if not init_db(force=True):
+            raise RuntimeError('データベース初期化に失敗しました')
         return jsonify({'status': 'success', 'message': 'データベースが初期化されました'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'初期化失敗: {str(e)}'}), 500
+
+# インポートジョブ登録
+@app.route('/api/jobs/import', methods=['POST'])
+def create_import_job():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        items = extract_import_items(request.json)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'インポートに失敗しました: {str(e)}'}), 400
+    
+    try:
+        job_id = job_queue.submit('import', run_import, items)
+        return jsonify({'success': True, 'message': 'インポートを開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"インポートジョブ登録エラー: {e}")
+        return jsonify({'success': False, 'message': f'インポートに失敗しました: {str(e)}'}), 500
+
+# エクスポートジョブ登録
+@app.route('/api/jobs/export', methods=['POST'])
+def create_export_job():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        job_id = job_queue.submit('export', run_export)
+        return jsonify({'success': True, 'message': 'エクスポートを開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"エクスポートジョブ登録エラー: {e}")
+        return jsonify({'success': False, 'message': f'エクスポートに失敗しました: {str(e)}'}), 500
+
+# DB初期化（マイグレーション）ジョブ登録
+@app.route('/api/jobs/init-db', methods=['POST'])
+def create_init_db_job():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        job_id = job_queue.submit('init-db', run_init_db)
+        return jsonify({'success': True, 'message': 'データベース初期化を開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"初期化ジョブ登録エラー: {e}")
+        return jsonify({'success': False, 'message': f'初期化に失敗しました: {str(e)}'}), 500
+
+# 履歴圧縮ジョブ登録（古い履歴をアーカイブへ移す）
+@app.route('/api/jobs/history-compaction', methods=['POST'])
+def create_history_compaction_job():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        job_id = job_queue.submit('history-compaction', run_history_compaction)
+        return jsonify({'success': True, 'message': '履歴の圧縮を開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"履歴圧縮ジョブ登録エラー: {e}")
+        return jsonify({'success': False, 'message': f'履歴の圧縮に失敗しました: {str(e)}'}), 500
+
+# 利用状況集計の再構築ジョブ登録（既存の履歴から集計し直す）
+@app.route('/api/jobs/analytics-backfill', methods=['POST'])
+def create_analytics_backfill_job():
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        job_id = job_queue.submit('analytics-backfill', run_analytics_backfill)
+        return jsonify({'success': True, 'message': '集計の再構築を開始しました', 'job_id': job_id}), 202
+    except Exception as e:
+        print(f"集計再構築ジョブ登録エラー: {e}")
+        return jsonify({'success': False, 'message': f'集計の再構築に失敗しました: {str(e)}'}), 500
+
+# ジョブの進捗・結果取得
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'success': False, 'message': 'ジョブが見つかりません'}), 404
+        return jsonify({'success': True, 'job': job})
+    except Exception as e:
+        print(f"ジョブ取得エラー: {e}")
+        return jsonify({'success': False, 'message': 'ジョブの取得に失敗しました'}), 500
+
+# ジョブのキャンセル
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    auth_check = require_admin()
+    if auth_check:
+        return auth_check
+    
+    try:
+        if job_queue.cancel(job_id):
+            return jsonify({'success': True, 'message': 'キャンセルを受け付けました'})
+        if job_queue.get(job_id, include_result=False) is None:
+            return jsonify({'success': False, 'message': 'ジョブが見つかりません'}), 404
+        return jsonify({'success': False, 'message': 'このジョブは既に終了しています'}), 409
+    except Exception as e:
+        print(f"ジョブキャンセルエラー: {e}")
+        return jsonify({'success': False, 'message': 'キャンセルに失敗しました'}), 500
         
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
@@ -753,7 +1742,18 @@ def admin_login():
         cursor.close()
         conn.close()
         
-        if result and check_password_hash(result['password_hash'] if DATABASE_URL else result[0], password):
+        verified = False
+        if result:
+            password_hash = result['password_hash'] if DATABASE_URL else result[0]
+            try:
+                verified, new_hash = credentials.verify_password(password_hash, password)
+            except credentials.HashPoolBusy:
+                return hash_pool_busy_response()
+            # ハッシュ方式の設定が変わっていれば新しい方式で保存し直す
+            if verified and new_hash and update_admin_password_hash(username, new_hash):
+                credentials.record_rehash()
+        
+        if verified:
             # セッションに管理者情報を保存
             session['user_type'] = 'admin'
             session['username'] = username
@@ -766,6 +1766,27 @@ def admin_login():
         print(f"ログインエラー: {e}")
         return jsonify({'success': False, 'message': 'ログインに失敗しました'}), 500
 
+# 管理者のパスワードハッシュを更新する（ログイン時の再ハッシュ用。失敗してもログインは継続）
+def update_admin_password_hash(username, password_hash):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if DATABASE_URL:
+            cursor.execute('UPDATE admin_users SET password_hash = %s WHERE username = %s', (password_hash, username))
+        else:
+            cursor.execute('UPDATE admin_users SET password_hash = ? WHERE username = ?', (password_hash, username))
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return True
+    except Exception as e:
+        if conn:
+            conn.rollback()
+            conn.close()
+        print(f"パスワード再ハッシュ保存エラー: {e}")
+        return False
+
 # 職員ログイン処理
 @app.route('/api/staff/login', methods=['POST'])
 def staff_login():
@@ -820,6 +1841,15 @@ def require_admin():
         return jsonify({'success': False, 'message': '管理者権限が必要です'}), 403
     return None
 
+# facility_idを整数に変換（未指定・不正な値はNone）
+def parse_facility_id(value):
+    try:
+        if value and str(value).strip():
+            return int(value)
+    except (ValueError, TypeError):
+        pass
+    return None
+
 # 入力値検証関数
 def validate_equipment_data(data):
     errors = []
@@ -910,7 +1940,7 @@ def init_admin_table():
             print("SQLite用テーブル作成")
         
         # デフォルト管理者作成
-        hashed_password = generate_password_hash('admin123')
+        hashed_password = credentials.hash_password('admin123')
         print(f"ハッシュ化パスワード: {hashed_password[:20]}...")
         
         if DATABASE_URL:
@@ -937,6 +1967,7 @@ def init_admin_table():
         
 if __name__ == '__main__':
     init_db()
+    warm_up()
     port = int(os.environ.get('PORT', 8080))
     host = '0.0.0.0' if os.environ.get('ENVIRONMENT') == 'production' else '127.0.0.1'
     app.run(debug=app.config['DEBUG'], host=host, port=port)
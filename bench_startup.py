@@ -0,0 +1,118 @@
+"""コールドスタートの計測
+
+gunicorn（gunicorn.conf.py）を起動し、以下の時間を計測する。
+  - ポートが接続を受け付けるまで
+  - /ready が200を返すまで（ウォームアップ完了）
+  - 最初のAPIリクエスト（/api/equipment）が返るまで
+
+使い方:
+    python bench_startup.py                 # SQLite（一時ディレクトリで起動）
+    python bench_startup.py --runs 5 --database-url postgresql://...
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def wait_for(predicate, deadline):
+    while time.monotonic() < deadline:
+        if predicate():
+            return time.monotonic()
+        time.sleep(0.01)
+    raise TimeoutError('起動待ちがタイムアウトしました')
+
+
+def run_once(env, workdir, workers, timeout):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--config', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+    ]
+    begin = time.monotonic()
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = begin + timeout
+        listening = wait_for(lambda: request_status(f'{base}/health') == 200, deadline)
+        ready = wait_for(lambda: request_status(f'{base}/ready') == 200, deadline)
+        status = request_status(f'{base}/api/equipment')
+        first_request = time.monotonic()
+        if status != 200:
+            raise RuntimeError(f'/api/equipment が {status} を返しました')
+        return {
+            'listening': listening - begin,
+            'ready': ready - begin,
+            'first_request': first_request - begin,
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='コールドスタート時間を計測します')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+
+    env = dict(os.environ, ENVIRONMENT='development', SCHEDULER_ENABLED='0')
+    env.pop('DATABASE_URL', None)
+    if args.database_url:
+        env['DATABASE_URL'] = args.database_url
+
+    # SQLiteのDBファイルやセッションを作業ディレクトリに閉じ込める
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    env['PYTHONPATH'] = APP_DIR
+    results = []
+    try:
+        for i in range(args.runs):
+            result = run_once(env, workdir, args.workers, args.timeout)
+            # 1回目はスキーマ作成を含むため、2回目以降が通常の再起動に相当する
+            result['run'] = i + 1
+            results.append(result)
+            print(f"[{i + 1}] listening {result['listening']:.3f}s  ready {result['ready']:.3f}s  "
+                  f"first request {result['first_request']:.3f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {}
+    for key in ('listening', 'ready', 'first_request'):
+        values = [r[key] for r in results]
+        summary[key] = {'median': round(statistics.median(values), 3), 'max': round(max(values), 3)}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""プロセス内の小さなLRUキャッシュ"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    # maxsize: 最大件数, max_bytes: 値の合計サイズ上限, ttl: 有効期限（秒、Noneで無期限）
+    def __init__(self, maxsize=256, max_bytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 削除・全消去のたびに進める世代番号（読み込み中に無効化された値を保存しないため）
+        self._generation = 0
+
+    @staticmethod
+    def _sizeof(value):
+        try:
+            return len(value)
+        except TypeError:
+            return 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # DBから読む前に取得し、set() に渡す
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    # generation を指定した場合、取得後に無効化されていれば保存しない（古い値で上書きしないため）
+    def set(self, key, value, generation=None):
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        self._bytes -= self._sizeof(value)
+
+    # 条件に一致するキーをすべて削除する
+    def discard_if(self, predicate):
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
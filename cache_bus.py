@@ -0,0 +1,192 @@
+"""ワーカー間のキャッシュ無効化通知
+
+gunicornで複数ワーカーを起動すると、メモリ上のキャッシュはプロセスごとに別々になる。
+あるワーカーで書き込みがあった場合に他のワーカーのキャッシュも破棄できるよう、
+PostgreSQLでは LISTEN/NOTIFY、SQLiteでは変更カウンタ表（cache_versions）で通知する。
+"""
+import json
+import os
+import select
+import threading
+import time
+
+CHANNEL = 'stockeasy_cache'
+
+# SQLite版で変更カウンタを確認する最小間隔（秒）
+POLL_INTERVAL = float(os.environ.get('CACHE_BUS_POLL_INTERVAL', 0.5))
+
+
+class _BaseBus:
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.received = 0
+
+    # topicの無効化通知を受け取る関数を登録する。callback(key) の key が None なら全件破棄
+    def subscribe(self, topic, callback):
+        with self._lock:
+            self._subscribers.setdefault(topic, []).append(callback)
+
+    def _dispatch(self, topic, key):
+        with self._lock:
+            callbacks = list(self._subscribers.get(topic, []))
+        self.received += 1
+        for callback in callbacks:
+            try:
+                callback(key)
+            except Exception as e:
+                print(f"キャッシュ無効化エラー ({topic}): {e}")
+
+    def _dispatch_all(self):
+        with self._lock:
+            topics = list(self._subscribers)
+        for topic in topics:
+            self._dispatch(topic, None)
+
+    def start(self):
+        pass
+
+    def poll(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.backend, 'published': self.published, 'received': self.received}
+
+
+class PostgresBus(_BaseBus):
+    backend = 'postgres'
+
+    # listen_connection: LISTEN用の接続を返す関数（プールに返さず保持し続けるため別にする）
+    def __init__(self, get_connection, listen_connection=None):
+        super().__init__(get_connection)
+        self.listen_connection = listen_connection or get_connection
+        self._thread = None
+        self._stop = threading.Event()
+
+    def publish(self, topic, key=None):
+        payload = json.dumps({'topic': topic, 'key': key, 'pid': os.getpid()}, ensure_ascii=False)
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_notify(%s, %s)', (CHANNEL, payload))
+            conn.commit()
+            cursor.close()
+            self.published += 1
+        finally:
+            conn.close()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # 受信用スレッドを起動する（フォーク後のワーカーで呼ぶ）
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._listen, name='cache-bus', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _listen(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.listen_connection()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f'LISTEN {CHANNEL}')
+                # 接続が切れていた間の通知は失われるため、再接続時は全件破棄する
+                self._dispatch_all()
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._handle(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"キャッシュ通知の受信エラー: {e}")
+                self._stop.wait(5)
+            finally:
+                if conn:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _handle(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        # 自プロセスの書き込みは発行時に破棄済み
+        if message.get('pid') == os.getpid():
+            return
+        self._dispatch(message.get('topic'), message.get('key'))
+
+
+class SQLiteBus(_BaseBus):
+    backend = 'sqlite'
+
+    def __init__(self, get_connection):
+        super().__init__(get_connection)
+        self._versions = None
+        self._last_poll = 0.0
+
+    # topicのカウンタを1つ進める（SQLite版はキー単位ではなくtopic単位で通知する）
+    def publish(self, topic, key=None):
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO cache_versions (topic, version) VALUES (?, 1)
+                ON CONFLICT (topic) DO UPDATE SET version = version + 1
+            ''', (topic,))
+            cursor.execute('SELECT version FROM cache_versions WHERE topic = ?', (topic,))
+            version = cursor.fetchone()['version']
+            conn.commit()
+            cursor.close()
+            self.published += 1
+        finally:
+            conn.close()
+
+        # 自プロセスの書き込みだけで進んだ場合は、次回の確認で全件破棄しないようにする
+        with self._lock:
+            if self._versions is not None and self._versions.get(topic, 0) == version - 1:
+                self._versions[topic] = version
+
+    # 他ワーカーの書き込みを確認する（リクエストごとに呼ばれるため間引く）
+    def poll(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_poll < POLL_INTERVAL:
+            return
+        self._last_poll = now
+
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT topic, version FROM cache_versions')
+            current = {row['topic']: row['version'] for row in cursor.fetchall()}
+            cursor.close()
+        finally:
+            conn.close()
+
+        with self._lock:
+            previous = self._versions
+            self._versions = current
+        if previous is None:
+            return
+        for topic, version in current.items():
+            if previous.get(topic) != version:
+                self._dispatch(topic, None)
+
+
+def create_bus(get_connection, use_postgres, listen_connection=None):
+    if use_postgres:
+        return PostgresBus(get_connection, listen_connection)
+    return SQLiteBus(get_connection)
@@ -0,0 +1,199 @@
+"""ワーカー間のキャッシュ無効化の確認
+
+gunicornを複数ワーカーで起動し、1つのワーカーで書き込んだ内容が、他のワーカーの
+/api/equipment/<id> と /api/facilities に CACHE_BUS_POLL_INTERVAL 以内に反映されるかを確認する。
+反映されなかった場合は終了コード1で終了する。
+
+ワーカーはHTTPのkeep-alive接続ごとに固定されるため、接続を複数張って
+/ready が返すPIDでワーカーを識別し、ワーカーごとに1本ずつ接続を使う。
+
+使い方:
+    python check_cache_bus.py                  # SQLite（一時ディレクトリで起動）
+    python check_cache_bus.py --workers 4
+    python check_cache_bus.py --database-url postgresql://localhost/stockeasy_test
+
+PostgreSQLを指定した場合は検査用の備品・施設を登録する（備品は終了時に削除する）。
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from bench_startup import APP_DIR, free_port, request_status, wait_for
+
+POLL_INTERVAL = float(os.environ.get('CACHE_BUS_POLL_INTERVAL', 0.5))
+
+# 反映待ちの判定に加える余裕（確認リクエスト自体の時間など）
+SLACK = 0.5
+
+
+class WorkerClient:
+    def __init__(self, port, cookie=None):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        self.cookie = cookie
+        self.pid = self.request('GET', '/ready')[1]['pid']
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        payload = json.dumps(body) if body is not None else None
+        self.connection.request(method, path, body=payload, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.getheader('Set-Cookie'):
+            self.cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+        return response.status, json.loads(data) if data else None
+
+    def close(self):
+        self.connection.close()
+
+
+# ワーカーごとに1本ずつ接続を確保する
+def connect_workers(port, workers, attempts=500):
+    clients = {}
+    spare = []
+    for _ in range(attempts):
+        client = WorkerClient(port)
+        if client.pid in clients:
+            spare.append(client)
+        else:
+            clients[client.pid] = client
+        if len(clients) == workers:
+            break
+        # 待機中のワーカーに accept の順番が回るよう少し待つ
+        time.sleep(0.01)
+    for client in spare:
+        client.close()
+    if len(clients) < workers:
+        raise RuntimeError(f'{workers} ワーカー中 {len(clients)} ワーカーにしか接続できませんでした')
+    return list(clients.values())
+
+
+# 全ワーカーで値が変わるまでの時間を測る（変わらなかったワーカーはNone）
+def wait_for_change(clients, path, changed, timeout):
+    elapsed = {}
+    begin = time.monotonic()
+    while time.monotonic() - begin < timeout and len(elapsed) < len(clients):
+        for client in clients:
+            if client.pid in elapsed:
+                continue
+            status, data = client.request('GET', path)
+            if status == 200 and changed(data):
+                elapsed[client.pid] = time.monotonic() - begin
+        time.sleep(0.02)
+    return {client.pid: elapsed.get(client.pid) for client in clients}
+
+
+def run(args, env, workdir):
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--config', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+        '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers), '--keep-alive', '60',
+    ]
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    writer = None
+    item_id = f'BUS-{uuid.uuid4().hex[:8]}'
+    try:
+        wait_for(lambda: request_status(f'http://127.0.0.1:{port}/ready') == 200, time.monotonic() + 60)
+        clients = connect_workers(port, args.workers)
+        writer, readers = clients[0], clients[1:]
+        print(f'ワーカー: {[client.pid for client in clients]}（書き込み: {writer.pid}）')
+
+        status, data = writer.request('POST', '/api/admin/login', {'username': 'admin', 'password': 'admin123'})
+        if status != 200:
+            raise RuntimeError(f'管理者ログインに失敗しました: {data}')
+        status, data = writer.request('POST', '/api/equipment', {
+            'id': item_id, 'name': '通知確認用', 'category': 'その他', 'location': '事務所',
+            'status': '利用可能', 'note': 'before',
+        })
+        if status not in (200, 201):
+            raise RuntimeError(f'備品の登録に失敗しました: {data}')
+
+        # 各ワーカーのキャッシュに載せる
+        for client in readers:
+            client.request('GET', f'/api/equipment/{item_id}')
+            client.request('GET', '/api/facilities')
+
+        limit = POLL_INTERVAL + SLACK
+        failures = []
+
+        note = f'after-{uuid.uuid4().hex[:6]}'
+        writer.request('PUT', f'/api/equipment/{item_id}', {'note': note})
+        results = wait_for_change(readers, f'/api/equipment/{item_id}',
+                                  lambda data: (data.get('item') or data).get('note') == note, limit * 4)
+        failures += report('備品', results, limit)
+
+        facility_name = f'通知確認用施設-{uuid.uuid4().hex[:6]}'
+        writer.request('POST', '/api/facilities', {'name': facility_name, 'admin_password': 'check'})
+        results = wait_for_change(readers, '/api/facilities',
+                                  lambda data: any(f['name'] == facility_name for f in data['facilities']),
+                                  limit * 4)
+        failures += report('施設', results, limit)
+        return failures
+    finally:
+        if writer is not None:
+            try:
+                writer.request('DELETE', f'/api/equipment/{item_id}')
+            except Exception:
+                pass
+        for client in clients:
+            client.close()
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def report(label, results, limit):
+    failures = []
+    for pid, elapsed in results.items():
+        if elapsed is None:
+            print(f'[NG] {label}: ワーカー {pid} に反映されませんでした')
+            failures.append((label, pid))
+        elif elapsed > limit:
+            print(f'[NG] {label}: ワーカー {pid} への反映に {elapsed:.3f}秒（上限 {limit:.3f}秒）')
+            failures.append((label, pid))
+        else:
+            print(f'[OK] {label}: ワーカー {pid} に {elapsed:.3f}秒で反映')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ワーカー間のキャッシュ無効化を確認します')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error('--workers は2以上を指定してください')
+
+    env = dict(os.environ, ENVIRONMENT='development', SCHEDULER_ENABLED='0', PYTHONPATH=APP_DIR,
+               CACHE_BUS_POLL_INTERVAL=str(POLL_INTERVAL),
+               RATE_LIMIT_READ_PER_SEC='1000', RATE_LIMIT_READ_BURST='1000',
+               RATE_LIMIT_LOGIN_BURST=str(5 * args.workers))
+    env.pop('DATABASE_URL', None)
+    if args.database_url:
+        env['DATABASE_URL'] = args.database_url
+
+    workdir = tempfile.mkdtemp(prefix='check_cache_bus_')
+    try:
+        failures = run(args, env, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print(f'{len(failures)} 件の反映漏れ・遅延があります')
+        return 1
+    print('すべてのワーカーに反映されました')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
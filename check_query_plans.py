@@ -0,0 +1,437 @@
+"""クエリ実行計画の回帰チェック
+
+大量の疑似データを投入したデータベースで主要なルート・定期処理を実際に呼び出し、
+その間にアプリが発行したSQLを記録して実行計画を検査する。大きなテーブルを全表走査した場合や、
+推定コストが予算（query_plan_budget.json）を超えた・予算が未記録の場合に失敗（終了コード1）する。
+予算ファイルが空の場合と、記録時と疑似データの件数が異なる場合は推定コストの検査を省略する。
+シナリオのレスポンスが2xxでない場合も、検査したいクエリが実行されていないため失敗とする。
+SQLをここに書き写さないため、アプリ側のクエリを変更すると検査対象も自動的に変わる。
+
+使い方:
+    python check_query_plans.py                       # SQLite（一時ディレクトリに作成）
+    python check_query_plans.py --database-url postgresql://localhost/stockeasy_plans
+    python check_query_plans.py --database-url ... --record   # PostgreSQLのコスト予算を記録
+
+PostgreSQLを指定した場合、そのデータベースのテーブルを削除して作り直すため、
+必ず検査専用のデータベースを使うこと。
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plan_budget.json')
+
+# 記録時に実測コストに掛ける余裕と、予算の最小値（関数呼び出しだけの文など推定コストがほぼ0のもの用）
+BUDGET_MARGIN = 1.5
+BUDGET_MIN = 1.0
+
+TABLES = (
+    'schema_version', 'overdue_loans', 'active_loans', 'usage_daily', 'history_archive', 'jobs',
+    'cache_versions', 'admin_users', 'users', 'equipment', 'facilities',
+)
+
+CATEGORIES = ['車いす', '歩行器・シルバーカー', '家具・家電', 'エアマット', 'その他']
+LOCATIONS = ['事務所', '1F', '2F', '3F', '4F', '5F', '地域交流室', '機能訓練室']
+
+
+# 全表走査を許容しない（疑似データを大量に投入する）テーブル
+LARGE_TABLES = ('equipment', 'history_archive', 'usage_daily', 'active_loans')
+
+SAMPLE_FACILITY = 3
+
+
+def item_id_for(index):
+    return f'ITEM-{index:06d}'
+
+
+# 検査で操作する備品（--items に合わせて中央付近の備品を使う）
+def sample_items(items):
+    return item_id_for(items // 2), item_id_for(items // 2 + 1)
+
+
+class _Job:
+    """compact_all などのジョブ関数に渡す最小限の実行コンテキスト"""
+
+    def set_progress(self, *args, **kwargs):
+        pass
+
+    def check_cancelled(self, *args, **kwargs):
+        pass
+
+
+# アプリが発行したSQLを記録するカーソル・接続
+class RecordingCursor:
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+
+    def execute(self, sql, params=()):
+        self._recorder.record(sql, params)
+        return self._cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RecordingConnection:
+    def __init__(self, conn, recorder):
+        self._conn = conn
+        self._recorder = recorder
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self._conn.cursor(*args, **kwargs), self._recorder)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class Recorder:
+    def __init__(self, get_connection):
+        self._get_connection = get_connection
+        self.scenario = None
+        self.statements = []
+
+    def connect(self):
+        conn = self._get_connection()
+        return RecordingConnection(conn, self) if conn is not None else None
+
+    # 検査対象は SELECT / UPDATE / DELETE（同じSQLはシナリオごとに1回だけ）
+    def record(self, sql, params):
+        normalized = ' '.join(sql.split())
+        keyword = normalized.split(' ', 1)[0].upper()
+        if self.scenario is None or keyword not in ('SELECT', 'UPDATE', 'DELETE'):
+            return
+        if normalized in ('SELECT 1',) or 'pg_notify' in normalized or 'cache_versions' in normalized:
+            return
+        for scenario, seen, _ in self.statements:
+            if scenario == self.scenario['name'] and seen == normalized:
+                return
+        self.statements.append((self.scenario['name'], normalized, tuple(params or ())))
+
+
+# 検査シナリオ（アプリのルート・関数を実際に呼び、発行されたSQLの実行計画を検査する）
+# allow_scan: 全表走査を許容するテーブル, allow_sort: SQLiteでORDER BYの一時B-treeを許容する
+def scenarios(app, recorder, use_postgres, sample_item, delete_item):
+    client = app.app.test_client()
+    item = f'/api/equipment/{sample_item}'
+    return [
+        {'name': 'admin_login',
+         'run': lambda: client.post('/api/admin/login', json={'username': 'admin', 'password': 'admin123'})},
+        # 一覧は全件を返すため、全表走査（登録日時インデックスの全走査）を許容する
+        {'name': 'equipment_list', 'run': lambda: client.get('/api/equipment'),
+         'allow_scan': ('equipment',)},
+        {'name': 'equipment_list_card', 'run': lambda: client.get('/api/equipment?fields=card,history'),
+         'allow_scan': ('equipment',)},
+        {'name': 'equipment_item',
+         'run': lambda: (app.equipment_item_cache.clear(), client.get(item),
+                         client.get(f'{item}?facility_id={SAMPLE_FACILITY}'))},
+        {'name': 'equipment_image', 'run': lambda: client.get(f'{item}/image/thumb')},
+        {'name': 'equipment_borrow_return',
+         'run': lambda: (client.put(item, json={'status': '使用中', 'user': '2F'}),
+                         client.put(item, json={'status': '待機', 'user': ''}),
+                         client.put(item, json={'note': '点検済み'}))},
+        {'name': 'history_archive_page', 'run': lambda: client.get(f'{item}/history/archive')},
+        {'name': 'facilities',
+         'run': lambda: (app.facilities_cache.clear(), client.get('/api/facilities'))},
+        # active_loans は貸出中の備品だけを持つため、施設ごとの突き合わせでの全件読み込み（ハッシュ結合）を許容する
+        {'name': 'overdue_scan', 'run': lambda: app.overdue.scan_all(recorder.connect, use_postgres),
+         'allow_scan': ('active_loans',)},
+        {'name': 'overdue_fetch',
+         'run': lambda: (client.get('/api/equipment/overdue'),
+                         client.get(f'/api/equipment/overdue?facility_id={SAMPLE_FACILITY}')),
+         'allow_sort': True},
+        {'name': 'analytics',
+         'run': lambda: [client.get(f'/api/analytics?group={group}&from=2025-03-01&to=2025-03-31'
+                                    f'&facility_id={SAMPLE_FACILITY}')
+                         for group in ('facility', 'category', 'item')],
+         'allow_sort': True},
+        {'name': 'jobs',
+         'run': lambda: (app.job_queue.get('0' * 32), app.job_queue.sweep())},
+        # 進捗表示用の件数（COUNT(*)）は全件を数える
+        {'name': 'history_compaction',
+         'run': lambda: app.history_archive.compact_all(_Job(), recorder.connect, use_postgres),
+         'allow_scan': ('equipment',)},
+        {'name': 'equipment_delete', 'run': lambda: client.delete(f'/api/equipment/{delete_item}')},
+    ]
+
+
+# シナリオの戻り値に含まれるレスポンスのうち、2xx以外のもの
+def _failed_responses(result):
+    results = result if isinstance(result, (list, tuple)) else [result]
+    return [response for response in results
+            if hasattr(response, 'status_code') and not 200 <= response.status_code < 300]
+
+
+# シナリオを実行して発行されたSQLを集める
+# レスポンスが2xxでないシナリオは、検査したいクエリまで到達していないため失敗として返す
+def capture(app, use_postgres, sample_item, delete_item):
+    recorder = Recorder(app.get_db_connection)
+    app.get_db_connection = recorder.connect
+    app.job_queue.get_connection = recorder.connect
+    errors = []
+    for scenario in scenarios(app, recorder, use_postgres, sample_item, delete_item):
+        recorder.scenario = scenario
+        for response in _failed_responses(scenario['run']()):
+            errors.append(f"{scenario['name']}: {response.request.method} {response.request.path} "
+                          f"が {response.status_code} を返しました")
+    recorder.scenario = None
+    options = {scenario['name']: scenario
+               for scenario in scenarios(app, recorder, use_postgres, sample_item, delete_item)}
+    return [(options[name], sql, params) for name, sql, params in recorder.statements], errors
+
+
+def budget_key(scenario, sql):
+    return f"{scenario['name']}:{hashlib.sha1(sql.encode('utf-8')).hexdigest()[:10]}"
+
+
+def _sample_image():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (40, 120, 200)).save(buffer, 'JPEG')
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def seed(app, conn, use_postgres, items, facilities):
+    ph = '%s' if use_postgres else '?'
+    cursor = conn.cursor()
+    random.seed(0)
+    base = datetime(2025, 1, 1)
+    sample_item, _ = sample_items(items)
+
+    for index in range(facilities):
+        cursor.execute(
+            f'INSERT INTO facilities (name, address, phone) VALUES ({ph}, {ph}, {ph})',
+            (f'施設{index:03d}', '', '')
+        )
+
+    rows = []
+    archive_rows = []
+    for index in range(items):
+        item_id = item_id_for(index)
+        created = base + timedelta(minutes=index)
+        in_use = random.random() < 0.3 and item_id != sample_item
+        history = [{'action': '借用', 'place': '2F', 'timestamp': created.strftime('%Y/%m/%d %H:%M:%S')}]
+        rows.append((
+            item_id, f'備品{index}', random.choice(LOCATIONS), random.choice(CATEGORIES),
+            '2F' if in_use else '', '2F' if in_use else '', '使用中' if in_use else '待機',
+            json.dumps(history), SAMPLE_FACILITY if item_id == sample_item else random.randint(1, facilities),
+            created.strftime('%Y-%m-%d %H:%M:%S'), created.strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+        for entry in range(3):
+            archive_rows.append((item_id, json.dumps({'n': entry}), f'{index}-{entry}'))
+
+    cursor.executemany(f'''
+        INSERT INTO equipment (
+            item_id, name, location, category, current_location, user_location,
+            status, history, facility_id, created_at, updated_at
+        ) VALUES ({', '.join([ph] * 11)})
+    ''', rows)
+    cursor.executemany(
+        f'INSERT INTO history_archive (item_id, entry, entry_key) VALUES ({ph}, {ph}, {ph})',
+        archive_rows
+    )
+    # 画像ルートの検査用（貸出・返却の検査のため待機中・SAMPLE_FACILITY の備品にしておく）
+    image = _sample_image()
+    cursor.execute(
+        f'UPDATE equipment SET image = {ph}, image_hash = {ph} WHERE item_id = {ph}',
+        (image, app.image_hash_for(image), sample_item)
+    )
+
+    usage_rows = []
+    for day in range(365):
+        day_key = (base + timedelta(days=day)).strftime('%Y-%m-%d')
+        for facility_id in range(1, facilities + 1):
+            usage_rows.append((day_key, facility_id, '', ''))
+            for category in CATEGORIES:
+                usage_rows.append((day_key, facility_id, category, ''))
+    cursor.executemany(
+        f'INSERT INTO usage_daily (day, facility_id, category, item_id) VALUES ({ph}, {ph}, {ph}, {ph})',
+        usage_rows
+    )
+    cursor.executemany(
+        f'INSERT INTO active_loans (item_id, facility_id, category, started_at) VALUES ({ph}, {ph}, {ph}, {ph})',
+        [(row[0], row[8], row[3], row[9]) for row in rows if row[6] == '使用中']
+    )
+    conn.commit()
+
+    if use_postgres:
+        conn.autocommit = True
+        cursor.execute('ANALYZE')
+        conn.autocommit = False
+    else:
+        cursor.execute('ANALYZE')
+        conn.commit()
+    cursor.close()
+
+
+def drop_tables(conn):
+    cursor = conn.cursor()
+    for table in TABLES:
+        cursor.execute(f'DROP TABLE IF EXISTS {table} CASCADE')
+    conn.commit()
+    cursor.close()
+
+
+# SQLiteの実行計画を検査する（コスト推定がないため構造のみ）
+# SCAN は USING [COVERING] INDEX でもインデックス全体をたどるため、全表走査として扱う
+def check_sqlite(cursor, scenario, sql, params):
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    details = [row['detail'] for row in cursor.fetchall()]
+    problems = []
+    for detail in details:
+        words = detail.split()
+        if len(words) >= 2 and words[0] == 'SCAN':
+            table = words[1]
+            if table in LARGE_TABLES and table not in scenario.get('allow_scan', ()):
+                problems.append(f'{table} を全表走査しています')
+        if 'USE TEMP B-TREE FOR ORDER BY' in detail and not scenario.get('allow_sort'):
+            problems.append('一時B-treeによる並べ替えが発生しています')
+    return details, None, problems
+
+
+def _walk(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _walk(child)
+
+
+# 条件なしのインデックススキャン（並べ替えのためにインデックス全体をたどる）も全表走査として扱う
+def _is_full_scan(node):
+    if node['Node Type'] == 'Seq Scan':
+        return True
+    return node['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in node
+
+
+# PostgreSQLの実行計画を検査する（全表走査と推定コスト）
+# budget が None の場合は予算を検査しない（記録時）
+def check_postgres(cursor, scenario, sql, params, budget):
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    result = cursor.fetchone()
+    plan_json = result['QUERY PLAN'] if isinstance(result, dict) else result[0]
+    if isinstance(plan_json, str):
+        plan_json = json.loads(plan_json)
+    plan = plan_json[0]['Plan']
+    nodes = list(_walk(plan))
+    details = [
+        f"{node['Node Type']}" + (f" on {node['Relation Name']}" if 'Relation Name' in node else '')
+        + (f" using {node['Index Name']}" if 'Index Name' in node else '')
+        for node in nodes
+    ]
+    cost = plan['Total Cost']
+    problems = []
+    for node in nodes:
+        table = node.get('Relation Name')
+        if (_is_full_scan(node) and table in LARGE_TABLES
+                and table not in scenario.get('allow_scan', ())):
+            problems.append(f'{table} を全表走査しています')
+    if budget is not None:
+        limit = budget.get(budget_key(scenario, sql))
+        if limit is None:
+            problems.append('コスト予算が記録されていません（--record で記録してください）')
+        elif cost > limit:
+            problems.append(f'推定コスト {cost:.1f} が予算 {limit:.1f} を超えています')
+    return details, cost, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='主要クエリの実行計画を検査します')
+    parser.add_argument('--database-url', help='検査に使うPostgreSQL（省略時はSQLite）')
+    parser.add_argument('--items', type=int, default=20000, help='投入する備品数（2件以上）')
+    parser.add_argument('--facilities', type=int, default=20, help='投入する施設数')
+    parser.add_argument('--record', action='store_true', help='PostgreSQLの推定コストを予算として記録する')
+    args = parser.parse_args()
+    if args.items < 2:
+        parser.error('--items は2以上を指定してください')
+
+    use_postgres = bool(args.database_url)
+    workdir = tempfile.mkdtemp(prefix='stockeasy-plans-')
+    os.chdir(workdir)
+    if use_postgres:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        os.environ.pop('DATABASE_URL', None)
+    os.environ['SCHEDULER_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    conn = app.get_db_connection()
+    if conn is None:
+        print('データベースに接続できません')
+        return 2
+    if use_postgres:
+        drop_tables(conn)
+    app.init_db(force=True)
+    print(f'疑似データを投入中: 備品 {args.items} 件, 施設 {args.facilities} 件')
+    seed(app, conn, use_postgres, args.items, args.facilities)
+
+    with open(BUDGET_FILE, encoding='utf-8') as f:
+        budgets = json.load(f)
+    budget = budgets.get('postgres') or {}
+    seed_size = {'items': args.items, 'facilities': args.facilities}
+    if use_postgres and not args.record:
+        if not budget:
+            print('コスト予算が未記録のため、推定コストの検査を省略します（--record で記録できます）')
+            budget = None
+        elif budgets.get('seed') != seed_size:
+            print(f"予算の記録時（{budgets.get('seed')}）と疑似データの件数が異なるため、推定コストの検査を省略します")
+            budget = None
+
+    conn.close()
+    get_connection = app.get_db_connection
+    app.warm_up()
+    statements, errors = capture(app, use_postgres, *sample_items(args.items))
+
+    failures = len(errors)
+    for error in errors:
+        print(f'[NG] {error}')
+    measured = {}
+    conn = get_connection()
+    cursor = conn.cursor()
+    for scenario, sql, params in statements:
+        key = budget_key(scenario, sql)
+        if use_postgres:
+            details, cost, problems = check_postgres(cursor, scenario, sql, params,
+                                                     None if args.record else budget)
+            measured[key] = cost
+        else:
+            details, cost, problems = check_sqlite(cursor, scenario, sql, params)
+        status = 'NG' if problems else 'OK'
+        cost_text = f' (cost {cost:.1f})' if cost is not None else ''
+        print(f'[{status}] {key}{cost_text}')
+        print(f'      {sql[:160]}')
+        for detail in details:
+            print(f'      {detail}')
+        for problem in problems:
+            print(f'      ! {problem}')
+        failures += bool(problems)
+    conn.rollback()
+    cursor.close()
+    conn.close()
+
+    if args.record and use_postgres:
+        budgets['seed'] = seed_size
+        budgets['postgres'] = {key: max(BUDGET_MIN, math.ceil(cost * BUDGET_MARGIN * 10) / 10)
+                               for key, cost in sorted(measured.items())}
+        with open(BUDGET_FILE, 'w', encoding='utf-8') as f:
+            json.dump(budgets, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'予算を記録しました: {BUDGET_FILE}')
+
+    if failures:
+        print(f'{failures} 件のクエリで問題が見つかりました')
+        return 1
+    print('すべてのクエリが基準を満たしています')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""パスワードハッシュ計算用のワーカープール
+
+パスワードハッシュ（PBKDF2/scrypt）は意図的に重い計算のため、ログインが集中すると
+リクエストスレッドがハッシュ計算で埋まり、一覧表示などの通常リクエストが待たされる。
+ハッシュ計算は専用のスレッドプールで行い、同時実行数と待ち行列を制限して
+あふれた分は待たせずに拒否する（hashlib はOpenSSLでの計算中にGILを解放する）。
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+from admission import ConcurrencyLimiter, WORKER_THREADS
+
+# werkzeugの generate_password_hash に渡す方式（例: 'pbkdf2:sha256:600000', 'scrypt:32768:8:1'）
+# 変更すると、既存ユーザーは次回ログイン時に新しい方式で再ハッシュされる
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+
+# 同時に計算する数・待ち行列の上限・待ち時間（秒）
+# 計算中・待機中のログインはそれぞれリクエストスレッドを1本ずつ占有するため、
+# 既定では HASH_WORKERS + HASH_MAX_QUEUE をワーカーのスレッド数の半分までにして一覧表示用のスレッドを残す
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 1))
+HASH_MAX_QUEUE = int(os.environ.get('HASH_MAX_QUEUE', max(0, WORKER_THREADS // 2 - HASH_WORKERS)))
+HASH_QUEUE_TIMEOUT = float(os.environ.get('HASH_QUEUE_TIMEOUT', 2))
+
+# レイテンシの分位点を計算するために保持する件数
+LATENCY_SAMPLES = 200
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_limiter = ConcurrencyLimiter(HASH_WORKERS, HASH_MAX_QUEUE, HASH_QUEUE_TIMEOUT)
+_stats_lock = threading.Lock()
+_latencies = deque(maxlen=LATENCY_SAMPLES)
+_waits = deque(maxlen=LATENCY_SAMPLES)
+_counts = {'hashed': 0, 'verified': 0, 'rehashed': 0, 'rejected': 0}
+
+
+# gunicornのマスターで作ったスレッドはフォーク後のワーカーに存在しないため、PIDが変わったら作り直す
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _count(name):
+    with _stats_lock:
+        _counts[name] += 1
+
+
+# werkzeugが省略された引数に補う既定値（scryptの n, r, p）
+SCRYPT_DEFAULTS = (2 ** 15, 8, 1)
+
+
+# 設定値から、werkzeugが生成するハッシュの方式部分を組み立てる（ハッシュ計算はしない）
+# 'pbkdf2' → 'pbkdf2:sha256:600000'、'scrypt' → 'scrypt:32768:8:1' のように既定値を補う
+def _method_prefix(method):
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = [int(value) for value in args] + list(SCRYPT_DEFAULTS[len(args):])
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    return method
+
+
+_current_prefix = _method_prefix(PASSWORD_HASH_METHOD)
+
+
+# 保存済みハッシュの方式部分（'$'より前）が現在の設定と異なれば再ハッシュが必要
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != _current_prefix
+
+
+def _verify(password_hash, password):
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash):
+        return True, generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+    return True, None
+
+
+# 枠を確保してプールで実行する。枠が空かなければ HashPoolBusy
+def _run(func, *args):
+    queued = time.monotonic()
+    if not _limiter.acquire():
+        _count('rejected')
+        raise HashPoolBusy('認証処理が混雑しています')
+    started = time.monotonic()
+    try:
+        return _get_executor().submit(func, *args).result()
+    finally:
+        _limiter.release()
+        with _stats_lock:
+            _waits.append(started - queued)
+            _latencies.append(time.monotonic() - started)
+
+
+def hash_password(password):
+    _count('hashed')
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+# パスワードを照合する
+# 戻り値: (一致したか, 再ハッシュ後の値。方式が最新ならNone)
+# 再ハッシュ後の値を保存できたら record_rehash() を呼ぶ
+def verify_password(password_hash, password):
+    _count('verified')
+    return _run(_verify, password_hash, password)
+
+
+def record_rehash():
+    _count('rehashed')
+
+
+def _percentile_ms(values, ratio):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * ratio))] * 1000, 1)
+
+
+def stats():
+    with _stats_lock:
+        latencies = list(_latencies)
+        waits = list(_waits)
+        counts = dict(_counts)
+    return {
+        'method': PASSWORD_HASH_METHOD,
+        'workers': HASH_WORKERS,
+        'max_queue': HASH_MAX_QUEUE,
+        'active': _limiter.active,
+        'queue_depth': _limiter.waiting,
+        'latency_ms_p50': _percentile_ms(latencies, 0.5),
+        'latency_ms_p95': _percentile_ms(latencies, 0.95),
+        'latency_ms_max': round(max(latencies) * 1000, 1) if latencies else None,
+        'queue_wait_ms_p95': _percentile_ms(waits, 0.95),
+        **counts,
+    }
@@ -0,0 +1,132 @@
+"""PostgreSQL接続プール
+
+リクエストごとに接続を張り直すとTLSハンドシェイクと認証の分だけ遅くなるため、
+ワーカープロセスごとに接続を使い回す。既存コードは conn.close() で接続を手放すので、
+close() でプールに返却するラッパーを返す。
+psycopg2 はPostgreSQLを使う場合にだけ読み込む。
+"""
+import os
+import threading
+
+PG_POOL_MIN = int(os.environ.get('PG_POOL_MIN', 1))
+PG_POOL_MAX = int(os.environ.get('PG_POOL_MAX', 20))
+PG_POOL_TIMEOUT = float(os.environ.get('PG_POOL_TIMEOUT', 10))
+
+# 日時はUTCで保存するため、CURRENT_TIMESTAMP もサーバー設定によらずUTCにする（SQLiteと同じ）
+SESSION_OPTIONS = '-c TimeZone=UTC'
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, pool, conn):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    # 接続を閉じずにプールへ返却する
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        self._pool.release(conn)
+
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=PG_POOL_MIN, maxconn=PG_POOL_MAX, timeout=PG_POOL_TIMEOUT):
+        import psycopg2.pool
+        from psycopg2.extras import RealDictCursor
+
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, cursor_factory=RealDictCursor, options=SESSION_OPTIONS
+        )
+        self._count_lock = threading.Lock()
+        self.in_use = 0
+
+    def connect(self):
+        # 上限に達している場合はエラーにせず、空くまで待つ
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout('データベース接続の空き待ちがタイムアウトしました')
+        try:
+            conn = self._pool.getconn()
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._count_lock:
+            self.in_use += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.closed:
+                self._pool.putconn(conn, close=True)
+            else:
+                conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+                self._pool.putconn(conn)
+        except Exception:
+            self._pool.putconn(conn, close=True)
+        finally:
+            with self._count_lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def close(self):
+        self._pool.closeall()
+
+    def stats(self):
+        return {'in_use': self.in_use, 'max': self.maxconn}
+
+
+# このプロセス用のプールを返す
+# gunicornのフォーク前に作られたプールは子プロセスでは使えないため、PIDが変わったら作り直す
+def get_pool(dsn):
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(dsn)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def pool_stats():
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.stats()
+
+
+# プールを使わない専用接続（LISTENなど長時間保持する用途）
+def connect_direct(dsn):
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor, options=SESSION_OPTIONS)
+
+
+# プールを閉じる（gunicornのマスターでフォーク前に使った接続を子に引き継がないため）
+def close_pool():
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+        _pool_pid = None
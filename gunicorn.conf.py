@@ -0,0 +1,30 @@
+"""gunicorn設定
+
+アプリをマスターで一度だけ読み込み（preload）、DB初期化もマスターで1回だけ行う。
+各ワーカーはフォーク後に接続プールとキャッシュを温めてからリクエストを受け付ける。
+"""
+import os
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+# マスターでの初期化（スキーマが最新なら何もしない）
+def when_ready(server):
+    import app
+    import db_pool
+
+    app.init_db()
+    # マスターで開いた接続はワーカーに引き継がない
+    db_pool.close_pool()
+
+
+# ワーカーごとのウォームアップ（完了するまで /ready は503を返す）
+def post_worker_init(worker):
+    import app
+
+    # preload時の STARTED_AT はマスターでの読み込み時刻のため、ワーカーの起動時刻に置き換える
+    app.mark_worker_started()
+    app.warm_up()
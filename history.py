@@ -0,0 +1,202 @@
+"""貸出履歴の保持期間管理とアーカイブ
+
+equipment.history には直近の履歴だけを残し、古い履歴は history_archive テーブルへ
+移す。これにより貸出回数の多い備品でも1行あたりのサイズとJSON解析コストが一定に保たれる。
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# 行内に残す履歴の最大件数・最大日数（0で無制限）
+HISTORY_INLINE_MAX = int(os.environ.get('HISTORY_INLINE_MAX', 50))
+HISTORY_INLINE_DAYS = int(os.environ.get('HISTORY_INLINE_DAYS', 180))
+
+# バックグラウンド圧縮で1トランザクションあたりに処理する備品数
+HISTORY_COMPACTION_BATCH = int(os.environ.get('HISTORY_COMPACTION_BATCH', 100))
+
+# 画面から登録される日時は toLocaleString('ja-JP') 形式（例: 2025/1/5 9:03:00）
+TIMESTAMP_FORMATS = ('%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+# 画面（ブラウザ）の日時のタイムゾーン。履歴の日時の解釈と、集計の日付の区切りに使う
+# DBに保存する日時（active_loans.started_at など）はUTC
+CLIENT_TIMEZONE = os.environ.get('CLIENT_TIMEZONE', 'Asia/Tokyo')
+_client_tz = ZoneInfo(CLIENT_TIMEZONE)
+
+
+# 現在のUTC日時（タイムゾーン情報なし。DBの日時と同じ形式）
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# 画面のタイムゾーンの日時 → UTC
+def client_to_utc(value):
+    return value.replace(tzinfo=_client_tz).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# UTC → 画面のタイムゾーンの日時
+def utc_to_client(value):
+    return value.replace(tzinfo=timezone.utc).astimezone(_client_tz).replace(tzinfo=None)
+
+
+# 履歴の日時を画面のタイムゾーンの日時として解釈する（タイムゾーン付きのISO形式は変換する）
+def parse_history_timestamp(value):
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(_client_tz).replace(tzinfo=None)
+    return parsed
+
+
+# 履歴の日時をUTCで返す
+def history_timestamp_utc(value):
+    parsed = parse_history_timestamp(value)
+    return client_to_utc(parsed) if parsed else None
+
+
+# 履歴エントリの重複判定用キー（古い画面から同じ履歴が再送されても二重に保存しない）
+def entry_key(entry):
+    return hashlib.sha1(json.dumps(entry, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# 履歴を「行内に残すもの」と「アーカイブするもの」に分ける
+# 日時が解析できないエントリは件数の上限だけで判定する
+def split_history(history, now=None):
+    if not isinstance(history, list):
+        return history, []
+    keep = history
+    archive = []
+    if HISTORY_INLINE_MAX and len(keep) > HISTORY_INLINE_MAX:
+        archive = keep[:-HISTORY_INLINE_MAX]
+        keep = keep[-HISTORY_INLINE_MAX:]
+    if HISTORY_INLINE_DAYS:
+        cutoff = (now or utc_to_client(utc_now())) - timedelta(days=HISTORY_INLINE_DAYS)
+        index = 0
+        for entry in keep:
+            timestamp = parse_history_timestamp(entry.get('timestamp')) if isinstance(entry, dict) else None
+            if timestamp is None or timestamp >= cutoff:
+                break
+            index += 1
+        archive = archive + keep[:index]
+        keep = keep[index:]
+    return keep, archive
+
+
+# アーカイブテーブルへ書き込む（同じカーソル＝同じトランザクションで実行する）
+def archive_entries(cursor, use_postgres, item_id, facility_id, entries):
+    if not entries:
+        return 0
+    if use_postgres:
+        query = '''
+            INSERT INTO history_archive (item_id, facility_id, entry, entry_key, occurred_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (item_id, entry_key) DO NOTHING
+        '''
+    else:
+        query = '''
+            INSERT OR IGNORE INTO history_archive (item_id, facility_id, entry, entry_key, occurred_at)
+            VALUES (?, ?, ?, ?, ?)
+        '''
+    rows = []
+    for entry in entries:
+        timestamp = history_timestamp_utc(entry.get('timestamp')) if isinstance(entry, dict) else None
+        rows.append((
+            item_id,
+            facility_id,
+            json.dumps(entry, ensure_ascii=False),
+            entry_key(entry),
+            timestamp.strftime('%Y-%m-%d %H:%M:%S') if timestamp else None,
+        ))
+    cursor.executemany(query, rows)
+    return len(rows)
+
+
+# 全備品の履歴をバッチ単位で圧縮するバックグラウンドジョブ
+# 圧縮中に画面から履歴が更新された行は上書きせず、次回の実行に回す
+def compact_all(job, get_connection, use_postgres):
+    ph = '%s' if use_postgres else '?'
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) AS total FROM equipment')
+        total = cursor.fetchone()['total']
+
+        last_id = 0
+        processed = 0
+        compacted = 0
+        archived = 0
+        while True:
+            job.set_progress(processed, total)
+            cursor.execute(
+                f'SELECT id, item_id, facility_id, history FROM equipment '
+                f'WHERE id > {ph} ORDER BY id LIMIT {ph}',
+                (last_id, HISTORY_COMPACTION_BATCH)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                last_id = row['id']
+                try:
+                    history = json.loads(row['history']) if row['history'] else []
+                except ValueError:
+                    continue
+                keep, old_entries = split_history(history)
+                if not old_entries:
+                    continue
+                # updated_at は貸出状況の判定に使うため変更しない
+                cursor.execute(
+                    f'UPDATE equipment SET history = {ph} WHERE id = {ph} AND history = {ph}',
+                    (json.dumps(keep), row['id'], row['history'])
+                )
+                if cursor.rowcount == 0:
+                    continue
+                archived += archive_entries(cursor, use_postgres, row['item_id'], row['facility_id'], old_entries)
+                compacted += 1
+
+            conn.commit()
+            processed += len(rows)
+
+        job.set_progress(processed, total, force=True)
+        cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {'processed': processed, 'compacted': compacted, 'archived': archived}
+
+
+# アーカイブ済み履歴をページ単位で取得する（新しい順）
+def fetch_archive(cursor, use_postgres, item_id, page, per_page):
+    ph = '%s' if use_postgres else '?'
+    cursor.execute(f'SELECT COUNT(*) AS total FROM history_archive WHERE item_id = {ph}', (item_id,))
+    total = cursor.fetchone()['total']
+    cursor.execute(
+        f'SELECT entry FROM history_archive WHERE item_id = {ph} '
+        f'ORDER BY id DESC LIMIT {ph} OFFSET {ph}',
+        (item_id, per_page, (page - 1) * per_page)
+    )
+    entries = [json.loads(row['entry']) for row in cursor.fetchall()]
+    return entries, total
+
+
+# エクスポート用に全備品のアーカイブ済み履歴を取得する（備品IDごと、古い順）
+def fetch_all_archives(cursor):
+    cursor.execute('SELECT item_id, entry FROM history_archive ORDER BY item_id, id')
+    archives = {}
+    for row in cursor.fetchall():
+        archives.setdefault(row['item_id'], []).append(json.loads(row['entry']))
+    return archives
@@ -0,0 +1,235 @@
+"""備品画像のサーバーサイド変換パイプライン
+
+アップロードされた画像をデコード・再エンコードし、一覧用サムネイルや
+詳細表示用などの複数サイズを生成してディスクにキャッシュする。
+CPU負荷の高い変換処理はプロセスプールで実行し、リクエストスレッドを塞がない。
+"""
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from PIL import Image, ImageOps
+
+# サイズ名 -> 長辺の最大ピクセル数（Noneはオリジナル）
+IMAGE_SIZES = {
+    'thumb': 128,
+    'detail': 300,
+    'original': None,
+}
+
+# オリジナル画像も巨大なまま保存しないよう上限を設ける
+ORIGINAL_MAX_PX = int(os.environ.get('IMAGE_ORIGINAL_MAX_PX', 1600))
+JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 80))
+MAX_UPLOAD_BYTES = int(os.environ.get('IMAGE_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_TIMEOUT = float(os.environ.get('IMAGE_TIMEOUT', 20))
+
+# 派生画像キャッシュの上限（超えたら最終アクセスの古いものから削除する）と削除処理の間隔（秒）
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_CACHE_PRUNE_INTERVAL = float(os.environ.get('IMAGE_CACHE_PRUNE_INTERVAL', 3600))
+
+# 巨大な画像によるメモリ枯渇（decompression bomb）対策
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+_executor = None
+_executor_pid = None
+_executor_lock = Lock()
+
+
+# gunicornのワーカーはスレッドを持つため、forkで子プロセスを作るとロック状態ごと複製されて
+# デッドロックすることがある。forkserver（使えない環境ではspawn）で起動する
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=context)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# data URL（data:image/jpeg;base64,...）を生のバイト列に変換
+def decode_data_url(data_url):
+    if not data_url or not data_url.startswith('data:image/'):
+        raise ValueError('画像データの形式が不正です')
+    try:
+        header, encoded = data_url.split(',', 1)
+    except ValueError:
+        raise ValueError('画像データの形式が不正です')
+    if ';base64' not in header:
+        raise ValueError('画像データの形式が不正です')
+    # base64は4文字で3バイトなので、デコード前にサイズを確認できる
+    if len(encoded) * 3 // 4 > MAX_UPLOAD_BYTES:
+        raise ValueError('画像サイズが大きすぎます')
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except Exception:
+        raise ValueError('画像データの形式が不正です')
+
+
+def encode_data_url(raw):
+    return 'data:image/jpeg;base64,' + base64.b64encode(raw).decode('ascii')
+
+
+# 画像内容から算出するキャッシュキー（同じ画像なら同じ派生画像を共有する）
+# equipment.image_hash に保存し、画像URLのバージョンにも使う
+def image_key(data_url):
+    return hashlib.sha1(data_url.encode('utf-8')).hexdigest()
+
+
+# 子プロセスで実行される変換処理（pickle可能なようにモジュール直下に定義）
+def _render(raw, max_px, quality):
+    with Image.open(io.BytesIO(raw)) as img:
+        img.load()
+        # スマートフォン写真の回転情報を反映してからEXIFごと破棄する
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            rgba = img.convert('RGBA')
+            background.paste(rgba, mask=rgba.split()[-1])
+            img = background
+        if max_px:
+            img.thumbnail((max_px, max_px), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+def _run(raw, max_px):
+    future = _get_executor().submit(_render, raw, max_px, JPEG_QUALITY)
+    return future.result(timeout=IMAGE_TIMEOUT)
+
+
+# アップロード画像を検証・再エンコードし、保存用のdata URLを返す
+# 空文字列（画像削除）はそのまま返す
+def normalize_upload(data_url):
+    if not data_url:
+        return ''
+    raw = decode_data_url(data_url)
+    try:
+        rendered = _run(raw, ORIGINAL_MAX_PX)
+    except Exception as e:
+        print(f"画像変換エラー: {e}")
+        raise ValueError('画像を読み込めませんでした')
+    return encode_data_url(rendered)
+
+
+def _variant_path(key, size):
+    return os.path.join(IMAGE_CACHE_DIR, f'{key}_{size}.jpg')
+
+
+def _write_atomic(path, data):
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# キャッシュ済みの派生画像のパスを返す（未生成ならNone）。画像本体を読まずに済む
+def cached_variant_path(key, size):
+    if size not in IMAGE_SIZES:
+        raise ValueError('無効な画像サイズです')
+    path = _variant_path(key, size)
+    try:
+        # 最終アクセス時刻として更新時刻を使う（atimeは無効化されていることが多い）
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+# 指定サイズの派生画像のパスを返す（未生成なら生成してキャッシュする）
+def get_variant_path(data_url, size):
+    key = image_key(data_url)
+    path = cached_variant_path(key, size)
+    if path:
+        return path
+    path = _variant_path(key, size)
+    raw = decode_data_url(data_url)
+    _write_atomic(path, _run(raw, IMAGE_SIZES[size]))
+    return path
+
+
+# 派生画像をバックグラウンドで先行生成する（結果を待たない）
+def prefetch_variants(data_url):
+    if not data_url:
+        return
+    try:
+        key = image_key(data_url)
+        raw = decode_data_url(data_url)
+    except ValueError:
+        return
+    for size, max_px in IMAGE_SIZES.items():
+        path = _variant_path(key, size)
+        if os.path.exists(path):
+            continue
+        future = _get_executor().submit(_render, raw, max_px, JPEG_QUALITY)
+        future.add_done_callback(lambda f, path=path: _store_prefetched(f, path))
+
+
+def _store_prefetched(future, path):
+    try:
+        _write_atomic(path, future.result())
+    except Exception as e:
+        print(f"画像キャッシュ生成エラー: {e}")
+
+
+# キャッシュの合計サイズが上限を超えていれば、最終アクセスの古い派生画像から削除する
+# 書き込み途中で残った一時ファイルも削除する（スケジューラから定期実行）
+def prune_cache(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    try:
+        names = os.listdir(IMAGE_CACHE_DIR)
+    except FileNotFoundError:
+        return 0
+    files = []
+    removed = 0
+    now = time.time()
+    for name in names:
+        path = os.path.join(IMAGE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith('.tmp'):
+            if now - stat.st_mtime > IMAGE_TIMEOUT * 2:
+                removed += _remove(path)
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        removed += _remove(path)
+        total -= size
+    return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
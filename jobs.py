@@ -0,0 +1,349 @@
+"""プロセス内バックグラウンドジョブキュー
+
+インポート・エクスポート・DB初期化など時間のかかる処理をHTTPリクエストから
+切り離してワーカースレッドで実行する。ジョブの状態は jobs テーブルに保存するため、
+gunicornの別ワーカーからも進捗確認・キャンセルができる。
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# 進捗書き込み・キャンセル確認でDBを叩く最小間隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+# 終了したジョブの結果を消すまでの時間と、行ごと削除するまでの時間
+JOB_RESULT_RETENTION = timedelta(minutes=float(os.environ.get('JOB_RESULT_RETENTION_MINUTES', 60)))
+JOB_RETENTION = timedelta(hours=float(os.environ.get('JOB_RETENTION_HOURS', 168)))
+
+# 別ホストで実行中のジョブは生存確認できないため、この時間を過ぎたら放棄されたとみなす
+JOB_ORPHAN_TIMEOUT = timedelta(hours=float(os.environ.get('JOB_ORPHAN_HOURS', 6)))
+
+# 定期メンテナンス（放棄ジョブの回収・古いジョブの削除）の間隔（秒）
+JOB_SWEEP_INTERVAL = float(os.environ.get('JOB_SWEEP_INTERVAL', 600))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# ジョブ関数に渡される実行コンテキスト
+class JobContext:
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self.cancel_event = threading.Event()
+        self.progress = 0
+        self.total = None
+        self._last_flush = 0.0
+
+    # 進捗を記録する（DBへの書き込み・キャンセル確認は間引く）
+    # SQLiteでは書き込み中のジョブと進捗更新がロック競合するため、
+    # 進捗はメモリ上でのみ保持し、同一プロセスからの参照時に反映する
+    def set_progress(self, done, total=None, force=False):
+        self.progress = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if not force and now - self._last_flush < PROGRESS_INTERVAL:
+            self.check_cancelled()
+            return
+        self._last_flush = now
+        if self.queue.use_postgres:
+            self.queue._update(self.job_id, progress=done, total=total)
+        self.check_cancelled(refresh=True)
+
+    # キャンセル要求があれば JobCancelled を送出する
+    # 別ワーカーからのキャンセルはDBのフラグで伝わる
+    def check_cancelled(self, refresh=False):
+        if not self.cancel_event.is_set() and refresh:
+            if self.queue._cancel_requested(self.job_id):
+                self.cancel_event.set()
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+
+# ジョブを実行するプロセスの識別子（ホスト名:PID）
+def current_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    def __init__(self, get_connection, use_postgres, max_workers=JOB_WORKERS):
+        self.get_connection = get_connection
+        self.use_postgres = use_postgres
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._contexts = {}
+
+    @property
+    def ph(self):
+        return '%s' if self.use_postgres else '?'
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='job'
+                )
+            return self._executor
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            for context in self._contexts.values():
+                context.cancel_event.set()
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait, cancel_futures=True)
+                self._executor = None
+
+    # ジョブを登録してIDを返す。func(context, *args) の戻り値がジョブ結果になる
+    def submit(self, kind, func, *args):
+        job_id = uuid.uuid4().hex
+        # 行の登録前に実行中として記録する（登録直後に放棄ジョブと誤判定されないよう）
+        context = JobContext(self, job_id)
+        with self._lock:
+            self._contexts[job_id] = context
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'INSERT INTO jobs (id, kind, status, owner) VALUES ({self.ph}, {self.ph}, {self.ph}, {self.ph})',
+                (job_id, kind, STATUS_QUEUED, current_owner())
+            )
+            conn.commit()
+            cursor.close()
+        except Exception:
+            with self._lock:
+                self._contexts.pop(job_id, None)
+            raise
+        finally:
+            conn.close()
+
+        self._get_executor().submit(self._run, context, func, args)
+        return job_id
+
+    def _run(self, context, func, args):
+        job_id = context.job_id
+        try:
+            if context.cancel_event.is_set() or self._cancel_requested(job_id):
+                raise JobCancelled()
+            self._update(job_id, status=STATUS_RUNNING, started=True)
+            result = func(context, *args)
+            self._update(job_id, status=STATUS_SUCCEEDED, finished=True,
+                         progress=context.progress, total=context.total,
+                         result=json.dumps(result, ensure_ascii=False))
+        except JobCancelled:
+            self._update(job_id, status=STATUS_CANCELLED, finished=True)
+        except Exception as e:
+            print(f"ジョブ実行エラー ({job_id}): {e}")
+            self._update(job_id, status=STATUS_FAILED, finished=True, error=str(e))
+        finally:
+            with self._lock:
+                self._contexts.pop(job_id, None)
+
+    def _update(self, job_id, status=None, progress=None, total=None,
+                result=None, error=None, started=False, finished=False):
+        fields = []
+        values = []
+        for column, value in (('status', status), ('progress', progress), ('total', total),
+                              ('result', result), ('error', error)):
+            if value is not None:
+                fields.append(f'{column} = {self.ph}')
+                values.append(value)
+        if started:
+            fields.append('started_at = CURRENT_TIMESTAMP')
+        if finished:
+            fields.append('finished_at = CURRENT_TIMESTAMP')
+        if not fields:
+            return
+        values.append(job_id)
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'UPDATE jobs SET {", ".join(fields)} WHERE id = {self.ph}', values)
+            conn.commit()
+            cursor.close()
+        except Exception as e:
+            print(f"ジョブ状態更新エラー ({job_id}): {e}")
+        finally:
+            conn.close()
+
+    def _cancel_requested(self, job_id):
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT cancel_requested FROM jobs WHERE id = {self.ph}', (job_id,))
+            row = cursor.fetchone()
+            cursor.close()
+            return bool(row and row['cancel_requested'])
+        finally:
+            conn.close()
+
+    # 実行していたプロセスが終了した（gunicornの再起動・ワーカーの入れ替えなど）ジョブを失敗にする
+    # 同じホストのジョブはPIDの生存で、別ホストのジョブは登録からの経過時間で判定する
+    def reap_orphans(self):
+        host = socket.gethostname()
+        me = current_owner()
+        orphan_cutoff = (datetime.utcnow() - JOB_ORPHAN_TIMEOUT).strftime('%Y-%m-%d %H:%M:%S')
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'SELECT id, owner, created_at FROM jobs WHERE status IN ({self.ph}, {self.ph})',
+                (STATUS_QUEUED, STATUS_RUNNING)
+            )
+            rows = cursor.fetchall()
+            with self._lock:
+                own_jobs = set(self._contexts)
+
+            orphaned = []
+            for row in rows:
+                owner_host, _, owner_pid = (row['owner'] or '').rpartition(':')
+                if row['owner'] == me:
+                    dead = row['id'] not in own_jobs
+                elif owner_host == host and owner_pid.isdigit():
+                    dead = not _process_alive(int(owner_pid))
+                else:
+                    dead = str(row['created_at'])[:19] < orphan_cutoff
+                if dead:
+                    orphaned.append(row['id'])
+
+            for job_id in orphaned:
+                cursor.execute(
+                    f'UPDATE jobs SET status = {self.ph}, error = {self.ph}, finished_at = CURRENT_TIMESTAMP '
+                    f'WHERE id = {self.ph} AND status IN ({self.ph}, {self.ph})',
+                    (STATUS_FAILED, '実行中のプロセスが終了したため中断されました', job_id,
+                     STATUS_QUEUED, STATUS_RUNNING)
+                )
+            conn.commit()
+            cursor.close()
+            return len(orphaned)
+        finally:
+            conn.close()
+
+    # 古いジョブを整理する（結果は短期間で消し、行は保持期間を過ぎたら削除する）
+    def purge(self):
+        now = datetime.utcnow()
+        result_cutoff = (now - JOB_RESULT_RETENTION).strftime('%Y-%m-%d %H:%M:%S')
+        row_cutoff = (now - JOB_RETENTION).strftime('%Y-%m-%d %H:%M:%S')
+        placeholders = ', '.join([self.ph] * len(FINISHED_STATUSES))
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'DELETE FROM jobs WHERE status IN ({placeholders}) AND finished_at < {self.ph}',
+                (*FINISHED_STATUSES, row_cutoff)
+            )
+            deleted = cursor.rowcount
+            cursor.execute(
+                f'UPDATE jobs SET result = NULL WHERE result IS NOT NULL AND finished_at < {self.ph}',
+                (result_cutoff,)
+            )
+            conn.commit()
+            cursor.close()
+            return deleted
+        finally:
+            conn.close()
+
+    # 定期メンテナンス（スケジューラから実行）
+    def sweep(self):
+        self.reap_orphans()
+        self.purge()
+
+    # ジョブ情報を取得する（存在しなければNone）
+    def get(self, job_id, include_result=True):
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT * FROM jobs WHERE id = {self.ph}', (job_id,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            conn.close()
+        if not row:
+            return None
+
+        job = {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'progress': row['progress'] or 0,
+            'total': row['total'],
+            'error': row['error'],
+            'cancelRequested': bool(row['cancel_requested']),
+            'createdAt': _isoformat(row['created_at']),
+            'startedAt': _isoformat(row['started_at']),
+            'finishedAt': _isoformat(row['finished_at']),
+        }
+        with self._lock:
+            context = self._contexts.get(job_id)
+        if context and job['status'] == STATUS_RUNNING:
+            job['progress'] = context.progress
+            job['total'] = context.total
+        if include_result and row['status'] == STATUS_SUCCEEDED and row['result']:
+            job['result'] = json.loads(row['result'])
+        elif row['status'] == STATUS_SUCCEEDED:
+            job['resultExpired'] = True
+        return job
+
+    # キャンセルを要求する。終了済みのジョブはキャンセルできない
+    # 自プロセスで実行中のジョブはDB更新を待たずに停止させる
+    # （SQLiteではインポート中の書き込みロックでDB更新が失敗することがある）
+    def cancel(self, job_id):
+        with self._lock:
+            context = self._contexts.get(job_id)
+        if context:
+            context.cancel_event.set()
+
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            placeholders = ', '.join([self.ph] * len(FINISHED_STATUSES))
+            cursor.execute(
+                f'UPDATE jobs SET cancel_requested = 1 '
+                f'WHERE id = {self.ph} AND status NOT IN ({placeholders})',
+                (job_id, *FINISHED_STATUSES)
+            )
+            updated = cursor.rowcount > 0
+            conn.commit()
+            cursor.close()
+        except Exception as e:
+            if context is None:
+                raise
+            print(f"キャンセルフラグ更新エラー ({job_id}): {e}")
+            updated = True
+        finally:
+            conn.close()
+        return updated or context is not None
+
+
+def _isoformat(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
@@ -0,0 +1,155 @@
+"""長期貸出（返却遅れ）の検出
+
+施設ごとに (facility_id, status, updated_at) のインデックスを使って「使用中」の備品を探し、
+貸出開始（active_loans.started_at）から一定時間が経過したものを overdue_loans テーブルに書き出す。
+画面側は overdue_loans を読むだけでよく、全件を走査する必要がない。
+
+updated_at は備考や画像の編集でも更新されるため、貸出開始には使わない
+（active_loans に記録がない古い貸出のみ updated_at で代用する）。
+"""
+import json
+import os
+from datetime import datetime
+
+from history import utc_now
+
+STATUS_IN_USE = '使用中'
+
+# カテゴリ別の貸出期限（時間）。OVERDUE_THRESHOLDS にJSONで上書きできる
+# 例: OVERDUE_THRESHOLDS='{"車いす": 24, "エアマット": 336}'
+DEFAULT_THRESHOLD_HOURS = float(os.environ.get('OVERDUE_DEFAULT_HOURS', 72))
+CATEGORY_THRESHOLD_HOURS = {
+    '車いす': 24,
+    '歩行器・シルバーカー': 72,
+    '家具・家電': 168,
+    'エアマット': 336,
+    'その他': 72,
+}
+CATEGORY_THRESHOLD_HOURS.update(json.loads(os.environ.get('OVERDUE_THRESHOLDS', '{}')))
+
+SCAN_INTERVAL = float(os.environ.get('OVERDUE_SCAN_INTERVAL', 300))
+
+# 複数ワーカーが同時に検出しないためのPostgreSQLのアドバイザリロックのキー
+SCAN_LOCK_KEY = 7_300_101
+
+
+def threshold_hours(category):
+    return float(CATEGORY_THRESHOLD_HOURS.get(category, DEFAULT_THRESHOLD_HOURS))
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+
+# 1施設分を検出して overdue_loans を置き換える（施設未設定は facility_id = 0）
+# active_loans.started_at・updated_at ともにUTCで記録されている（since もUTCで保存する）
+def scan_facility(cursor, use_postgres, facility_id, now=None):
+    ph = '%s' if use_postgres else '?'
+    now = now or utc_now()
+
+    columns = 'e.item_id, e.name, e.category, e.user_location, e.updated_at, a.started_at'
+    source = 'equipment e LEFT JOIN active_loans a ON a.item_id = e.item_id'
+    if facility_id:
+        cursor.execute(
+            f'SELECT {columns} FROM {source} WHERE e.facility_id = {ph} AND e.status = {ph}',
+            (facility_id, STATUS_IN_USE)
+        )
+    else:
+        cursor.execute(
+            f'SELECT {columns} FROM {source} WHERE e.facility_id IS NULL AND e.status = {ph}',
+            (STATUS_IN_USE,)
+        )
+
+    overdue = []
+    for row in cursor.fetchall():
+        if row['started_at']:
+            since = _parse_timestamp(row['started_at'])
+        else:
+            since = _parse_timestamp(row['updated_at'])
+        limit = threshold_hours(row['category'])
+        elapsed = (now - since).total_seconds() / 3600
+        if elapsed >= limit:
+            overdue.append((
+                row['item_id'], facility_id or 0, row['name'], row['category'],
+                row['user_location'] or '', since.strftime('%Y-%m-%d %H:%M:%S'),
+                limit, round(elapsed, 1)
+            ))
+
+    cursor.execute(f'DELETE FROM overdue_loans WHERE facility_id = {ph}', (facility_id or 0,))
+    # 施設を移した備品が他施設の行として残っている場合もあるため上書きする
+    if overdue:
+        cursor.executemany(f'''
+            INSERT INTO overdue_loans (
+                item_id, facility_id, name, category, user_location,
+                since, threshold_hours, elapsed_hours
+            ) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+            ON CONFLICT (item_id) DO UPDATE SET
+                facility_id = excluded.facility_id, name = excluded.name,
+                category = excluded.category, user_location = excluded.user_location,
+                since = excluded.since, threshold_hours = excluded.threshold_hours,
+                elapsed_hours = excluded.elapsed_hours, detected_at = CURRENT_TIMESTAMP
+        ''', overdue)
+    return len(overdue)
+
+
+# 全施設を検出する（スケジューラから定期実行）
+# PostgreSQLでは他のワーカーが検出中なら何もしない（戻り値None）
+def scan_all(get_connection, use_postgres):
+    conn = get_connection()
+    locked = False
+    try:
+        cursor = conn.cursor()
+        if use_postgres:
+            cursor.execute('SELECT pg_try_advisory_lock(%s) AS locked', (SCAN_LOCK_KEY,))
+            locked = cursor.fetchone()['locked']
+            if not locked:
+                cursor.close()
+                return None
+        cursor.execute('SELECT id FROM facilities')
+        facility_ids = [row['id'] for row in cursor.fetchall()] + [None]
+        total = 0
+        for facility_id in facility_ids:
+            total += scan_facility(cursor, use_postgres, facility_id)
+            conn.commit()
+        cursor.close()
+        return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if locked:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (SCAN_LOCK_KEY,))
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                print(f"長期貸出検出のロック解放エラー: {e}")
+        conn.close()
+
+
+def fetch(cursor, use_postgres, facility_id=None):
+    ph = '%s' if use_postgres else '?'
+    query = ('SELECT item_id, facility_id, name, category, user_location, since, '
+             'threshold_hours, elapsed_hours, detected_at FROM overdue_loans')
+    params = ()
+    if facility_id is not None:
+        query += f' WHERE facility_id = {ph}'
+        params = (facility_id,)
+    cursor.execute(query + ' ORDER BY elapsed_hours DESC', params)
+    results = []
+    for row in cursor.fetchall():
+        results.append({
+            'id': row['item_id'],
+            'facility_id': row['facility_id'],
+            'name': row['name'],
+            'category': row['category'],
+            'user': row['user_location'],
+            'since': str(row['since']),
+            'thresholdHours': float(row['threshold_hours']),
+            'elapsedHours': float(row['elapsed_hours']),
+            'detectedAt': str(row['detected_at']),
+        })
+    return results
@@ -0,0 +1,289 @@
+"""備品の利用状況集計（日次ロールアップ）
+
+貸出・返却のたびに日次の集計行を更新し、分析APIは集計テーブルだけを読む。
+集計は次の3つの粒度で保持する（空文字列は「すべて」を表す）。
+  - 施設単位:       category = '', item_id = ''
+  - カテゴリ単位:   item_id = ''
+  - 備品単位
+施設未設定の備品は facility_id = 0 として集計する。
+日時はUTCで保存し、日付の区切り（usage_daily.day と分析APIの期間）は CLIENT_TIMEZONE の日付とする。
+
+貸出時間は返却日の集計に加算されるため、返却されていない貸出（active_loans）は
+分析APIの取得時に期間内の経過時間と同時貸出数を加える。
+"""
+import json
+from datetime import datetime, timedelta
+
+from history import client_to_utc, history_timestamp_utc, parse_history_timestamp, utc_now, utc_to_client
+
+STATUS_IN_USE = '使用中'
+ACTION_BORROW = '借用'
+ACTION_RETURN = '返却'
+
+
+def _ph(use_postgres):
+    return '%s' if use_postgres else '?'
+
+
+# UTCの日時 → 集計の日付（画面のタイムゾーン）
+def _day(at):
+    return utc_to_client(at).strftime('%Y-%m-%d')
+
+
+# 集計行に加算する（存在しなければ作成する）
+def _bump(cursor, use_postgres, day, facility_id, category, item_id,
+          borrows=0, returns=0, seconds=0, concurrent=0):
+    ph = _ph(use_postgres)
+    greatest = 'GREATEST' if use_postgres else 'MAX'
+    cursor.execute(f'''
+        INSERT INTO usage_daily (
+            day, facility_id, category, item_id,
+            borrow_count, return_count, total_loan_seconds, peak_concurrent
+        ) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ON CONFLICT (day, facility_id, category, item_id) DO UPDATE SET
+            borrow_count = usage_daily.borrow_count + excluded.borrow_count,
+            return_count = usage_daily.return_count + excluded.return_count,
+            total_loan_seconds = usage_daily.total_loan_seconds + excluded.total_loan_seconds,
+            peak_concurrent = {greatest}(usage_daily.peak_concurrent, excluded.peak_concurrent)
+    ''', (day, facility_id, category, item_id, borrows, returns, int(seconds), concurrent))
+
+
+def _count_active(cursor, use_postgres, facility_id, category=None):
+    ph = _ph(use_postgres)
+    if category is None:
+        cursor.execute(f'SELECT COUNT(*) AS active FROM active_loans WHERE facility_id = {ph}', (facility_id,))
+    else:
+        cursor.execute(
+            f'SELECT COUNT(*) AS active FROM active_loans WHERE facility_id = {ph} AND category = {ph}',
+            (facility_id, category)
+        )
+    return cursor.fetchone()['active']
+
+
+# 貸出開始を記録する（update_equipment と同じトランザクションで呼ぶ）
+# at はUTC（省略時は現在時刻）
+def record_borrow(cursor, use_postgres, item_id, facility_id, category, at=None):
+    ph = _ph(use_postgres)
+    at = at or utc_now()
+    facility_id = facility_id or 0
+    cursor.execute(f'DELETE FROM active_loans WHERE item_id = {ph}', (item_id,))
+    cursor.execute(
+        f'INSERT INTO active_loans (item_id, facility_id, category, started_at) VALUES ({ph}, {ph}, {ph}, {ph})',
+        (item_id, facility_id, category, at.strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    day = _day(at)
+    _bump(cursor, use_postgres, day, facility_id, category, item_id, borrows=1, concurrent=1)
+    _bump(cursor, use_postgres, day, facility_id, category, '', borrows=1,
+          concurrent=_count_active(cursor, use_postgres, facility_id, category))
+    _bump(cursor, use_postgres, day, facility_id, '', '', borrows=1,
+          concurrent=_count_active(cursor, use_postgres, facility_id))
+
+
+# 返却を記録する。貸出時間は返却日の集計に加算する
+def record_return(cursor, use_postgres, item_id, at=None):
+    ph = _ph(use_postgres)
+    at = at or utc_now()
+    cursor.execute(
+        f'SELECT facility_id, category, started_at FROM active_loans WHERE item_id = {ph}', (item_id,)
+    )
+    loan = cursor.fetchone()
+    if not loan:
+        return
+    cursor.execute(f'DELETE FROM active_loans WHERE item_id = {ph}', (item_id,))
+
+    started_at = loan['started_at']
+    if not isinstance(started_at, datetime):
+        started_at = parse_history_timestamp(str(started_at))
+    seconds = max(0, (at - started_at).total_seconds()) if started_at else 0
+
+    day = _day(at)
+    facility_id = loan['facility_id']
+    category = loan['category']
+    for bump_category, bump_item in ((category, item_id), (category, ''), ('', '')):
+        _bump(cursor, use_postgres, day, facility_id, bump_category, bump_item,
+              returns=1, seconds=seconds)
+
+
+# 備品の状態遷移から貸出・返却を判定して記録する
+def record_status_change(cursor, use_postgres, item_id, facility_id, category, old_status, new_status):
+    if old_status == new_status:
+        return
+    if new_status == STATUS_IN_USE:
+        record_borrow(cursor, use_postgres, item_id, facility_id, category)
+    elif old_status == STATUS_IN_USE:
+        record_return(cursor, use_postgres, item_id)
+
+
+# 既存の履歴（行内＋アーカイブ）から集計を作り直すバックグラウンドジョブ
+def backfill(job, get_connection, use_postgres):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT item_id, facility_id, category, status, history FROM equipment')
+        items = cursor.fetchall()
+
+        cursor.execute('SELECT item_id, entry FROM history_archive')
+        archived = {}
+        for row in cursor.fetchall():
+            archived.setdefault(row['item_id'], []).append(json.loads(row['entry']))
+
+        # 全備品の貸出・返却イベントを時系列に並べる
+        events = []
+        for index, item in enumerate(items):
+            job.set_progress(index, len(items))
+            try:
+                inline = json.loads(item['history']) if item['history'] else []
+            except ValueError:
+                inline = []
+            for entry in archived.get(item['item_id'], []) + inline:
+                if not isinstance(entry, dict):
+                    continue
+                at = history_timestamp_utc(entry.get('timestamp'))
+                if at and entry.get('action') in (ACTION_BORROW, ACTION_RETURN):
+                    events.append((at, entry['action'] == ACTION_BORROW, item))
+        events.sort(key=lambda event: event[0])
+
+        cursor.execute('DELETE FROM usage_daily')
+        cursor.execute('DELETE FROM active_loans')
+        borrowing = set()
+        for at, is_borrow, item in events:
+            item_id = item['item_id']
+            if is_borrow and item_id not in borrowing:
+                borrowing.add(item_id)
+                record_borrow(cursor, use_postgres, item_id, item['facility_id'], item['category'], at)
+            elif not is_borrow and item_id in borrowing:
+                borrowing.discard(item_id)
+                record_return(cursor, use_postgres, item_id, at)
+            job.check_cancelled()
+
+        # 履歴と現在の状態が食い違う場合は現在の状態に合わせる
+        now = utc_now()
+        for item in items:
+            if item['item_id'] in borrowing and item['status'] != STATUS_IN_USE:
+                cursor.execute(f'DELETE FROM active_loans WHERE item_id = {_ph(use_postgres)}', (item['item_id'],))
+            elif item['item_id'] not in borrowing and item['status'] == STATUS_IN_USE:
+                record_borrow(cursor, use_postgres, item['item_id'], item['facility_id'], item['category'], now)
+
+        job.set_progress(len(items), len(items), force=True)
+        conn.commit()
+        cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {'items': len(items), 'events': len(events)}
+
+
+# 集計結果を取得する
+# group_by: facility / category / item
+def query(cursor, use_postgres, group_by, date_from, date_to, facility_id=None):
+    ph = _ph(use_postgres)
+    conditions = [f'day >= {ph}', f'day <= {ph}']
+    params = [date_from, date_to]
+    if facility_id is not None:
+        conditions.append(f'facility_id = {ph}')
+        params.append(facility_id)
+
+    if group_by == 'facility':
+        conditions.append("category = ''")
+        key_columns = ['facility_id']
+    elif group_by == 'category':
+        conditions.append("category <> '' AND item_id = ''")
+        key_columns = ['facility_id', 'category']
+    else:
+        conditions.append("item_id <> ''")
+        key_columns = ['facility_id', 'category', 'item_id']
+
+    keys = ', '.join(key_columns)
+    cursor.execute(f'''
+        SELECT {keys},
+               SUM(borrow_count) AS borrow_count,
+               SUM(return_count) AS return_count,
+               SUM(total_loan_seconds) AS total_loan_seconds,
+               MAX(peak_concurrent) AS peak_concurrent
+        FROM usage_daily
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {keys}
+        ORDER BY borrow_count DESC
+    ''', params)
+
+    groups = {}
+    for row in cursor.fetchall():
+        result = {column: row[column] for column in key_columns}
+        result['borrowCount'] = int(row['borrow_count'] or 0)
+        result['returnCount'] = int(row['return_count'] or 0)
+        result['totalLoanSeconds'] = int(row['total_loan_seconds'] or 0)
+        result['avgLoanSeconds'] = (
+            result['totalLoanSeconds'] // result['returnCount'] if result['returnCount'] else None
+        )
+        result['peakConcurrent'] = int(row['peak_concurrent'] or 0)
+        result['activeLoans'] = 0
+        groups[tuple(row[column] for column in key_columns)] = result
+
+    _add_open_loans(cursor, use_postgres, groups, key_columns, date_from, date_to, facility_id)
+    results = sorted(groups.values(), key=lambda result: result['borrowCount'], reverse=True)
+
+    # 備品単位では一度も使われていない備品も0件として返す
+    if group_by == 'item':
+        used = {row['item_id'] for row in results}
+        if facility_id is not None:
+            cursor.execute(
+                f'SELECT item_id, facility_id, category FROM equipment WHERE facility_id = {ph}', (facility_id,)
+            )
+        else:
+            cursor.execute('SELECT item_id, facility_id, category FROM equipment')
+        for row in cursor.fetchall():
+            if row['item_id'] in used:
+                continue
+            results.append({
+                'facility_id': row['facility_id'] or 0,
+                'category': row['category'],
+                'item_id': row['item_id'],
+                'borrowCount': 0,
+                'returnCount': 0,
+                'totalLoanSeconds': 0,
+                'avgLoanSeconds': None,
+                'peakConcurrent': 0,
+                'activeLoans': 0,
+            })
+    return results
+
+
+# 期間終了までに始まり、まだ返却されていない貸出を集計に加える
+# 貸出時間は期間と重なる部分、同時貸出数は期間終了時点（今日なら現在）で貸出中の件数
+# 期間の日付は画面のタイムゾーンの日付として、UTCの started_at と比較する
+def _add_open_loans(cursor, use_postgres, groups, key_columns, date_from, date_to, facility_id=None):
+    ph = _ph(use_postgres)
+    range_start = client_to_utc(datetime.strptime(date_from, '%Y-%m-%d'))
+    range_end = min(client_to_utc(datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)), utc_now())
+    if range_end <= range_start:
+        return
+
+    query = f'SELECT item_id, facility_id, category, started_at FROM active_loans WHERE started_at <= {ph}'
+    params = [range_end.strftime('%Y-%m-%d %H:%M:%S')]
+    if facility_id is not None:
+        query += f' AND facility_id = {ph}'
+        params.append(facility_id)
+    cursor.execute(query, params)
+
+    for row in cursor.fetchall():
+        started_at = row['started_at']
+        if not isinstance(started_at, datetime):
+            started_at = parse_history_timestamp(str(started_at))
+        if started_at is None:
+            continue
+        seconds = max(0, (range_end - max(started_at, range_start)).total_seconds())
+
+        key = tuple(row[column] for column in key_columns)
+        result = groups.get(key)
+        if result is None:
+            result = {column: row[column] for column in key_columns}
+            result.update({
+                'borrowCount': 0, 'returnCount': 0, 'totalLoanSeconds': 0,
+                'avgLoanSeconds': None, 'peakConcurrent': 0, 'activeLoans': 0,
+            })
+            groups[key] = result
+        result['totalLoanSeconds'] += int(seconds)
+        result['activeLoans'] += 1
+        result['peakConcurrent'] = max(result['peakConcurrent'], result['activeLoans'])
@@ -0,0 +1,70 @@
+"""定期実行ジョブのスケジューラ
+
+ワーカープロセスごとにデーモンスレッドを1本起動し、登録されたジョブを一定間隔で実行する。
+gunicornでフォークした後に起動する必要があるため、最初のリクエスト時に start() を呼ぶ。
+"""
+import random
+import threading
+import time
+
+
+class Scheduler:
+    def __init__(self):
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = {}
+        self.errors = {}
+
+    # interval秒ごとに func() を実行するジョブを登録する
+    def add_job(self, name, interval, func):
+        with self._lock:
+            self._jobs.append({
+                'name': name,
+                'interval': interval,
+                'func': func,
+                # 複数ワーカーが同時に実行しないよう初回実行をずらす
+                'next_run': time.monotonic() + random.uniform(0, min(interval, 30)),
+            })
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                due = [job for job in self._jobs if job['next_run'] <= now]
+                for job in due:
+                    job['next_run'] = now + job['interval']
+                next_run = min((job['next_run'] for job in self._jobs), default=now + 60)
+            for job in due:
+                self._run(job)
+            self._stop.wait(max(0.1, next_run - time.monotonic()))
+
+    def _run(self, job):
+        try:
+            job['func']()
+            self.runs[job['name']] = self.runs.get(job['name'], 0) + 1
+        except Exception as e:
+            self.errors[job['name']] = self.errors.get(job['name'], 0) + 1
+            print(f"定期ジョブ実行エラー ({job['name']}): {e}")
+
+    def stats(self):
+        return {'running': self.running, 'runs': dict(self.runs), 'errors': dict(self.errors)}